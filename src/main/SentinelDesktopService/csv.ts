@@ -35,7 +35,8 @@ export class CsvFile {
       detection.classId,
       detection.confidence,
       detection.inputPath,
-      // To match the format output by the Python CLI
+      // The Python CLI's older single-column bbox layout. It now writes ymin, xmin, ymax, xmax columns,
+      // and reads this layout too (sinks.load_detections)
       `[${detection.bbox[0]}, ${detection.bbox[1]}, ${detection.bbox[2]}, ${detection.bbox[3]}]`,
     ]);
   }
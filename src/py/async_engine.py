@@ -0,0 +1,143 @@
+## Asyncio inference engine: a single process keeping a bounded number of requests in flight,
+## with decoding, drawing and saving done on a small thread pool
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import inference
+import profiling
+
+# The async engine is optional (pip install aiohttp)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger('first_logger')
+
+_DONE = object()
+
+
+def timed(name, function, *args):
+    with profiling.stage(name):
+        return function(*args)
+
+
+async def predict(session, loop, executor, images, model, transport, timeout=30, retries=5, backoff=0.2):
+    """Async counterpart of inference.predict, retrying refused connections and 5xx responses (on another replica if there are several)"""
+    if transport == 'grpc':
+        return await loop.run_in_executor(executor, inference.predict, images, model, transport, timeout)
+    encode = inference.encode_b64 if transport == 'b64' else inference.encode_json
+    data = await loop.run_in_executor(executor, timed, 'encode', encode, images)
+    limit = inference.request_limit()
+    if limit is None:
+        return await send(session, data, len(images), model, timeout, retries, backoff)
+    # Blocking here would stall the event loop, so poll for a slot
+    while not limit.acquire(block=False):
+        await asyncio.sleep(0.005)
+    start = loop.time()
+    failed = False
+    try:
+        return await send(session, data, len(images), model, timeout, retries, backoff)
+    except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+        failed = not (isinstance(e, aiohttp.ClientResponseError) and e.status < 500)
+        raise
+    finally:
+        limit.release(loop.time() - start, failed)
+
+
+async def send(session, data, count, model, timeout=30, retries=5, backoff=0.2):
+    headers = {"content-type": "application/json"}
+    attempt = 0
+    while True:
+        replica = inference.acquire_replica()
+        try:
+            # Covers the whole round trip, reading and parsing the response included, while other requests share the loop
+            with profiling.stage('request'):
+                async with session.post(inference.predict_url(model, port=inference.replica_port(replica)), data=data, headers=headers,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    predictions = (await response.json(content_type=None))['predictions']
+            inference.release_replica(replica)
+            break
+        except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+            failed = not (isinstance(e, aiohttp.ClientResponseError) and e.status < 500)
+            inference.release_replica(replica, failed)
+            if attempt == retries or not failed:
+                raise
+            # With other replicas to fail over to, there is no point waiting
+            if inference.replica_count() == 1:
+                await asyncio.sleep(backoff * 2 ** attempt)
+            attempt = attempt + 1
+    if len(predictions) != count:
+        raise ValueError(f'Expected {count} predictions, got {len(predictions)}')
+    return predictions
+
+
+async def feed(batches, todo, loop):
+    # The batch iterator may be a slow directory scan, so step it off the event loop.
+    # todo is bounded, so this stops pulling batches while the workers are busy
+    while True:
+        batch = await loop.run_in_executor(None, next, batches, _DONE)
+        await todo.put(batch)
+        if batch is _DONE:
+            return
+
+
+async def work(todo, results, session, loop, executor, prepare, finish, model, transport):
+    while True:
+        filenames = await todo.get()
+        if filenames is _DONE:
+            # Leave the marker for the other workers
+            await todo.put(_DONE)
+            return
+        done, pending = await loop.run_in_executor(executor, prepare, filenames)
+        predictions = []
+        if len(pending) != 0:
+            try:
+                predictions = await predict(session, loop, executor, [image for _, image, _ in pending], model, transport)
+            except Exception as e:
+                logger.warning(e)
+                predictions = [None] * len(pending)
+        batch_results = await loop.run_in_executor(executor, finish, filenames, done, pending, predictions)
+        # results is bounded too, so a slow consumer holds the workers back
+        await loop.run_in_executor(None, results.put, batch_results)
+
+
+async def run(batches, results, prepare, finish, model, transport, max_in_flight, decode_workers):
+    loop = asyncio.get_running_loop()
+    todo = asyncio.Queue(maxsize=max_in_flight)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            workers = [asyncio.create_task(work(todo, results, session, loop, executor, prepare, finish, model, transport))
+                       for _ in range(max_in_flight)]
+            await feed(iter(batches), todo, loop)
+            await asyncio.gather(*workers)
+
+
+def imap(batches, prepare, finish, model, transport, max_in_flight=8, decode_workers=4):
+    """Run batches of filenames through prepare -> predict -> finish on an event loop in a background thread.
+    Yields each batch's results as it completes, like Pool.imap_unordered(process_batch, batches)"""
+    if aiohttp is None:
+        raise ImportError('The async engine needs aiohttp installed')
+    results = queue.Queue(maxsize=max_in_flight)
+
+    def target():
+        try:
+            asyncio.run(run(batches, results, prepare, finish, model, transport, max_in_flight, decode_workers))
+        except BaseException as e:
+            results.put(e)
+        results.put(_DONE)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    while True:
+        item = results.get()
+        if item is _DONE:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    thread.join()
@@ -0,0 +1,563 @@
+## Throughput benchmarks against a running TF Serving container
+## e.g. python benchmark.py --input <folder> --model ic_rat --batch_sizes 1,4,8,16
+## Scaling over serving replicas: python benchmark.py --input <folder> --model ic_rat --org <org> --replicas 1,2,4
+## Decoding only (no container needed): python benchmark.py --decode
+## Non-maximum suppression only: python benchmark.py --nms
+## Timelapse export only: python benchmark.py --timelapse
+## Detection sinks only: python benchmark.py --sinks
+## Output placement only: python benchmark.py --placements reflink,copy,link,encode
+## Handing decoded images between processes only: python benchmark.py --ipc
+## Checkpoint overhead only: python benchmark.py --checkpoints 100,500
+## The whole pipeline on generated JPEGs against a stand-in server (no container needed):
+## python benchmark.py --pipeline pool,async,shm --fixtures 200 --resolution 1920x1080 --latency 0.02
+## Staying under a memory ceiling on a big folder: python benchmark.py --pipeline pool --fixtures 2000 --resolution 4000x3000 --max_memory 2g
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+import imaging
+import inference
+import nms
+import utils
+import sinks
+import render
+import resume
+import shm_ring
+import containers
+import docker
+import fake_serving
+
+# Peak RSS is only reported where the resource module exists (not on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def load_images(folder, input_size, max_images):
+    images = []
+    for path, subdirs, files in os.walk(folder):
+        for file in files:
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                images.append(Image.open(os.path.join(path, file)).resize([input_size, input_size]))
+                if len(images) == max_images:
+                    return images
+    return images
+
+
+def make_fixtures(folder, count, width, height, first=0):
+    """Write count synthetic JPEGs of width x height, noisy enough to compress like real photos.
+    They are numbered from first, so several folders of them don't share names"""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(first)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    paths = []
+    for i in range(first, first + count):
+        pixels = gradient + rng.normal(0, 40, (height, width, 3))
+        path = os.path.join(folder, f'fixture_{i}.jpg')
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def make_fixture_tree(folder, count, width, height, folders=4):
+    """count synthetic JPEGs spread over folders camera folders, like a card dump from several cameras"""
+    paths = []
+    for i in range(folders):
+        share = count // folders + (1 if i < count % folders else 0)
+        paths.extend(make_fixtures(os.path.join(folder, f'camera_{i}'), share, width, height, len(paths)))
+    return paths
+
+
+def decode_files(files, input_size, output_size, draft):
+    start = time.perf_counter()
+    for file in files:
+        imaging.preprocess(file, input_size, output_size, draft=draft)
+    ms = (time.perf_counter() - start) / len(files) * 1000
+    # ru_maxrss is kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    return ms, peak
+
+
+def bench_decode(files, input_size, output_size):
+    """Decode ms per image and peak RSS with and without draft mode. Each run gets a fresh process so peaks don't carry over"""
+    results = []
+    for draft in [False, True]:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            ms, peak = executor.submit(decode_files, files, input_size, output_size, draft).result()
+        results.append(('draft' if draft else 'full', ms, peak))
+    return results
+
+
+def synthetic_boxes(count, rng, clusters=20):
+    """count candidate boxes jittered around a few objects, like a detector's raw output"""
+    centres = rng.uniform(0.1, 0.9, (clusters, 2))[rng.integers(0, clusters, count)]
+    sizes = rng.uniform(0.05, 0.2, (count, 2))
+    jitter = rng.normal(0, 0.01, (count, 2))
+    boxes = np.concatenate([centres + jitter - sizes / 2, centres + jitter + sizes / 2], axis=1)
+    return boxes, rng.uniform(0, 1, count), rng.integers(1, 4, count)
+
+
+def bench_nms(counts, repeats=200):
+    """ms per image to suppress `count` candidate boxes, class-agnostic and per class"""
+    rng = np.random.default_rng(0)
+    results = []
+    for count in counts:
+        boxes, scores, class_ids = synthetic_boxes(count, rng)
+        row = [count]
+        for ids in [None, class_ids]:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                nms.nms_indices(boxes, scores, max_predictions=count, class_ids=ids)
+            row.append((time.perf_counter() - start) / repeats * 1000)
+        results.append(row)
+    return results
+
+
+def write_detections(folder, rows, rng, detections_per_image=3):
+    """A detections.csv with `rows` rows written through the run's own sink, about a third of images blank"""
+    sink = sinks.open_sink(folder, 'csv', flush_rows=10000)
+    written = 0
+    image = 0
+    while written < rows:
+        filename = f'/input/camera{image % 50}/img{image}.jpg'
+        if image % 3 == 0:
+            sink.write([(os.path.basename(filename),'blank',0,0.0,filename,np.nan,np.nan,np.nan,np.nan)])
+            written = written + 1
+        else:
+            for _ in range(min(detections_per_image, rows - written)):
+                ys = sorted(rng.uniform(0, 1, 2).tolist())
+                xs = sorted(rng.uniform(0, 1, 2).tolist())
+                sink.write([(os.path.basename(filename),'rat',1,float(rng.uniform(0.4, 1)),filename,ys[0],xs[0],ys[1],xs[1])])
+                written = written + 1
+        image = image + 1
+    sink.close()
+
+
+def bench_timelapse(row_counts):
+    """Seconds to build timelapse.json from detections.csv files of increasing size"""
+    rng = np.random.default_rng(0)
+    results = []
+    for rows in row_counts:
+        with tempfile.TemporaryDirectory() as folder:
+            write_detections(folder, rows, rng)
+            opt = argparse.Namespace(output=folder, input='/input', org='bench', model='bench', output_style='class')
+            start = time.perf_counter()
+            utils.generate_timelapse_file(opt)
+            results.append((rows, time.perf_counter() - start))
+    return results
+
+
+def bench_sinks(rows, formats):
+    """Rows/sec written through each sink, and seconds to load the result back with pandas"""
+    rng = np.random.default_rng(0)
+    batch = []
+    for i in range(rows):
+        filename = f'/input/camera{i % 50}/img{i // 3}.jpg'
+        batch.append((os.path.basename(filename),'rat',1,float(rng.uniform(0.4, 1)),filename,*rng.uniform(0, 1, 4).tolist()))
+    results = []
+    for format in formats:
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            sink = sinks.open_sink(folder, format)
+            for i in range(0, rows, 3):
+                sink.write(batch[i:i + 3])
+                if i % 1500 == 0:
+                    sink.checkpoint()
+            sink.close()
+            write = time.perf_counter() - start
+            start = time.perf_counter()
+            sinks.load_detections(folder)
+            results.append((format, rows / write, time.perf_counter() - start))
+    return results
+
+
+def bench_placements(files, placements):
+    """ms per image and bytes written to put full size, unannotated copies of files into an output folder.
+    A hard link writes no data. A reflink clone may share the source's blocks, so its bytes are an upper bound"""
+    results = []
+    for placement in placements:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(files[0])) as folder:
+            written = 0
+            start = time.perf_counter()
+            for file in files:
+                out_path = os.path.join(folder, os.path.basename(file))
+                if placement == 'encode':
+                    Image.open(file).save(out_path)
+                else:
+                    render.place_file(file, out_path, placement)
+                if placement != 'link':
+                    written = written + os.path.getsize(out_path)
+            results.append((placement, (time.perf_counter() - start) / len(files) * 1000, written))
+    return results
+
+
+_ring = None
+
+
+def attach_ring(name, slots, shape):
+    global _ring
+    _ring = shm_ring.SlotRing(slots, shape, name)
+
+
+def tensor(index, input_size):
+    return np.full((input_size, input_size, 3), index % 256, dtype=np.uint8)
+
+
+def tensor_to_slot(job):
+    index, slot, input_size = job
+    _ring.write(slot, tensor(index, input_size))
+    return slot
+
+
+def bench_ipc(count, input_size, workers=2, slots=64):
+    """ms per image for decode workers handing model inputs back through a pipe (pickled) or through shared memory slots.
+    The workers just fill an array, so the difference is the cost of the hand over itself"""
+    shape = (input_size, input_size, 3)
+    results = []
+    with ProcessPoolExecutor(workers) as executor:
+        start = time.perf_counter()
+        for image in executor.map(tensor, range(count), [input_size] * count, chunksize=8):
+            image.sum()
+        results.append(('pipe', (time.perf_counter() - start) / count * 1000))
+
+    ring = shm_ring.SlotRing(slots, shape)
+    try:
+        with ProcessPoolExecutor(workers, initializer=attach_ring, initargs=(ring.name, slots, shape)) as executor:
+            start = time.perf_counter()
+            for first in range(0, count, slots):
+                taken = ring.acquire(min(slots, count - first))
+                for slot in executor.map(tensor_to_slot, [(first + i, slot, input_size) for i, slot in enumerate(taken)], chunksize=8):
+                    ring.view(slot).sum()
+                ring.release(taken)
+            results.append(('shm', (time.perf_counter() - start) / count * 1000))
+    finally:
+        ring.close()
+    return results
+
+
+def bench_checkpoints(intervals, images=5000, rate=50):
+    """Cost of checkpointing the detections file and resume index every n images, as ms per checkpoint
+    and as a share of a run processing rate images/sec"""
+    results = []
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        # The index stats every input file, so they have to exist
+        os.makedirs(os.path.join(folder, 'in'))
+        paths = [os.path.join(folder, 'in', f'{i}.jpg') for i in range(images)]
+        for path in paths:
+            open(path, 'w').close()
+        for every in intervals:
+            output = os.path.join(folder, f'out_{every}')
+            os.makedirs(output)
+            index = resume.ResumeIndex(output)
+            sink = sinks.open_sink(output)
+            seconds = 0.0
+            for i, path in enumerate(paths):
+                box = rng.random(4).tolist()
+                sink.write([(os.path.basename(path), 'cat', 1, 0.9, path, *box)])
+                index.add(path)
+                if (i + 1) % every == 0:
+                    start = time.perf_counter()
+                    index.flush({'sink': {'format': 'csv', 'offset': sink.checkpoint()}, 'counts': {'images': i + 1}})
+                    seconds = seconds + time.perf_counter() - start
+            sink.close()
+            index.close()
+            count = images // every
+            ms = seconds / max(count, 1) * 1000
+            results.append((every, ms, ms / (every / rate * 1000) * 100))
+    return results
+
+
+def payload_size(images, model, transport):
+    if transport == 'grpc':
+        return inference.grpc_request(images, model).ByteSize()
+    if transport == 'b64':
+        return len(inference.encode_b64(images))
+    return len(inference.encode_json(images))
+
+
+def bench_transports(images, model, transports):
+    """Bytes on the wire and client CPU (encode + request + decode) per image for each transport"""
+    results = []
+    for transport in transports:
+        wire_bytes = sum(payload_size([image], model, transport) for image in images)
+        start = time.process_time()
+        for image in images:
+            inference.predict([image], model, transport)
+        cpu = time.process_time() - start
+        results.append((transport, wire_bytes / len(images), cpu / len(images) * 1000))
+    return results
+
+
+def bench_batch_sizes(images, model, batch_sizes, transport='json'):
+    results = []
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for batch in inference.batched(images, batch_size):
+            inference.predict(batch, model, transport)
+        elapsed = time.perf_counter() - start
+        results.append((batch_size, len(images) / elapsed))
+    return results
+
+
+def bench_replicas(images, model, replica_counts, batch_size=8, concurrency=16, transport='json', manager=None):
+    """images/sec with concurrency client threads spreading batches over each number of replicas.
+    With a manager the replicas are started (each pinned to its share of the CPUs), otherwise they must already be running"""
+    batches = list(inference.batched(images, batch_size))
+    results = []
+    for replicas in replica_counts:
+        if manager is not None:
+            manager.ensure_replicas(model, replicas)
+        ports = inference.replica_ports(replicas)
+        for port in ports:
+            inference.wait_until_ready(model, port=port)
+        inference.init_replicas(ports)
+        inference.init_session(concurrency)
+        with ThreadPoolExecutor(concurrency) as executor:
+            # Warm every replica up before timing
+            list(executor.map(lambda batch: inference.predict(batch, model, transport), batches[:concurrency]))
+            start = time.perf_counter()
+            list(executor.map(lambda batch: inference.predict(batch, model, transport), batches))
+            elapsed = time.perf_counter() - start
+        results.append((replicas, len(images) / elapsed))
+    inference.init_replicas([inference.REST_PORT])
+    return results
+
+
+def pipeline_run(workdir, args):
+    """Run runCli2.main in this process (a fresh one for each run) with args as its command line.
+    Returns the run's profile.json and the peak RSS of this process and of its biggest worker process"""
+    os.chdir(workdir)
+    # runCli2 reads the app's input data from the working folder as it is imported, and logs there
+    path = os.getcwd() + "\\src\\py\\inputData.json"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({}, file)
+    import runCli2
+    opt = runCli2.make_parser().parse_args(args)
+    runCli2.main(opt)
+    with open(os.path.join(opt.output, 'profile.json')) as file:
+        profile = json.load(file)
+    if resource is None:
+        return profile, None, None
+    return profile, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def bench_pipeline(input, engines, args, serving):
+    """The whole pipeline, from scanning input to the detections and output images, once per engine,
+    against serving (a fake_serving.FakeServing). Returns (engine, profile, peak RSS, biggest worker's peak RSS) per engine"""
+    results = []
+    serving.start()
+    try:
+        for engine in engines:
+            with tempfile.TemporaryDirectory() as workdir, ProcessPoolExecutor(max_workers=1) as executor:
+                output = os.path.join(workdir, 'output')
+                os.makedirs(output)
+                profile, peak, worker_peak = executor.submit(pipeline_run, workdir,
+                                                             ['--input', input, '--output', output, '--engine', engine] + args).result()
+            results.append((engine, profile, peak, worker_peak))
+    finally:
+        serving.close()
+    return results
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str,
+                        help='Folder of images to benchmark with')
+    parser.add_argument('--model', type=str,
+                        help='which model to run')
+    parser.add_argument('--replicas', type=str,
+                        help='comma separated replica counts to compare images/sec for, e.g. 1,2,4')
+    parser.add_argument('--org', type=str,
+                        help='with --replicas, start the replicas from this org\'s image (otherwise they must already be running)')
+    parser.add_argument('--concurrency', type=int,
+                        default=16, help='with --replicas, requests kept in flight')
+    parser.add_argument('--batch_size', type=int,
+                        default=8, help='with --replicas or --pipeline, images per request')
+    parser.add_argument('--checkpoints', type=str,
+                        help='only benchmark checkpointing every n images, e.g. 100,500')
+    parser.add_argument('--rate', type=float,
+                        default=50, help='with --checkpoints, images/sec of the run the overhead is measured against')
+    parser.add_argument('--ipc', action='store_true',
+                        help='only benchmark handing decoded images from worker processes through a pipe vs shared memory')
+    parser.add_argument('--placements', type=str,
+                        help='only benchmark placing output copies, on --input or generated 20 MP JPEGs, e.g. reflink,copy,link,encode')
+    parser.add_argument('--sinks', type=str,
+                        help='only benchmark the detection sinks, e.g. csv,jsonl,parquet')
+    parser.add_argument('--timelapse', action='store_true',
+                        help='only benchmark timelapse.json generation on synthetic detections.csv files')
+    parser.add_argument('--nms', action='store_true',
+                        help='only benchmark non-maximum suppression on synthetic boxes')
+    parser.add_argument('--decode', action='store_true',
+                        help='only benchmark decoding, on --input or on generated 20 MP JPEGs')
+    parser.add_argument('--output_size', type=int,
+                        help='size of images into output folder (decode benchmark)')
+    parser.add_argument('--fixtures', type=int,
+                        help='number of JPEGs to generate when --input is not given (10, or 200 for --pipeline)')
+    parser.add_argument('--pipeline', type=str,
+                        help='only benchmark whole runs with each of these engines against a stand-in server, e.g. pool,async,shm')
+    parser.add_argument('--resolution', type=str,
+                        default='1920x1080', help='with --pipeline, size of the generated JPEGs')
+    parser.add_argument('--folders', type=int,
+                        default=4, help='with --pipeline, folders the generated JPEGs are spread over')
+    parser.add_argument('--latency', type=float,
+                        default=0.02, help='with --pipeline, seconds the stand-in server takes per request')
+    parser.add_argument('--image_latency', type=float,
+                        default=0.002, help='with --pipeline, extra seconds the stand-in server takes per image')
+    parser.add_argument('--detections', type=float,
+                        default=1.0, help='with --pipeline, mean detections per image from the stand-in server')
+    parser.add_argument('--classes', type=int,
+                        default=2, help='with --pipeline, classes the stand-in model has')
+    parser.add_argument('--output_style', type=str,
+                        default='class', help='with --pipeline, how output images are arranged')
+    parser.add_argument('--min_rate', type=float,
+                        help='with --pipeline, exit with an error if any engine manages fewer images/sec, for CI')
+    parser.add_argument('--max_memory', type=str,
+                        help='with --pipeline, run under this memory budget (e.g. 2g) and exit with an error if any run goes over it')
+    parser.add_argument('--input_size', type=int,
+                        default=256, help='size of images into model')
+    parser.add_argument('--max_images', type=int,
+                        default=256, help='number of images to send per run')
+    parser.add_argument('--batch_sizes', type=str,
+                        default='1,2,4,8,16,32', help='comma separated batch sizes to try')
+    parser.add_argument('--transport', type=str, choices=inference.TRANSPORTS,
+                        default='json', help='transport used for the batch size runs')
+    parser.add_argument('--transports', type=str,
+                        help='comma separated transports to compare, e.g. json,b64,grpc')
+    opt = parser.parse_args()
+
+    if opt.sinks is not None:
+        print('  format     rows/sec  load seconds')
+        for format, rate, load in bench_sinks(200000, opt.sinks.split(',')):
+            print(f'{format:>8}  {rate:>11.0f}  {load:>12.3f}')
+        return
+
+    if opt.timelapse:
+        results = bench_timelapse([10000, 100000, 300000])
+        print('\n     rows  seconds  us/row')
+        for rows, seconds in results:
+            print(f'{rows:>9}  {seconds:>7.2f}  {seconds / rows * 1e6:>6.1f}')
+        return
+
+    if opt.nms:
+        print('candidates  agnostic ms  per class ms')
+        for count, agnostic_ms, class_ms in bench_nms([100, 300, 1000]):
+            print(f'{count:>10}  {agnostic_ms:>11.3f}  {class_ms:>12.3f}')
+        return
+
+    if opt.checkpoints is not None:
+        print(f'checkpoint every  ms/checkpoint  overhead at {opt.rate:g} images/sec')
+        for every, ms, overhead in bench_checkpoints([int(i) for i in opt.checkpoints.split(',')], rate=opt.rate):
+            print(f'{every:>16}  {ms:>13.2f}  {overhead:>6.2f}%')
+        return
+
+    if opt.ipc:
+        count = opt.max_images or 2000
+        print(f'{count} images at {opt.input_size}x{opt.input_size}')
+        print('hand over  ms/image')
+        for name, ms in bench_ipc(count, opt.input_size):
+            print(f'{name:>9}  {ms:>8.3f}')
+        return
+
+    if opt.pipeline is not None:
+        width, height = (int(i) for i in opt.resolution.split('x'))
+        with tempfile.TemporaryDirectory() as folder:
+            if opt.input is not None:
+                input = opt.input
+                print(f'Images in {input}')
+            else:
+                input = os.path.join(folder, 'input')
+                count = len(make_fixture_tree(input, opt.fixtures or 200, width, height, opt.folders))
+                print(f'{count} JPEGs of {opt.resolution} in {opt.folders} folders')
+            print(f'Stand-in model: {opt.latency:g}s per request + {opt.image_latency:g}s per image, '
+                  f'{opt.detections:g} detections per image, batch size {opt.batch_size}')
+            serving = fake_serving.FakeServing(latency=opt.latency, image_latency=opt.image_latency, detections=opt.detections,
+                                               classes=opt.classes, input_size=opt.input_size)
+            args = ['--model', 'fake', '--class_names', ','.join(f'class_{i}' for i in range(1, opt.classes + 1)),
+                    '--batch_size', str(opt.batch_size), '--transport', opt.transport, '--input_size', str(opt.input_size),
+                    '--output_style', opt.output_style]
+            if opt.output_size is not None:
+                args = args + ['--output_size', str(opt.output_size)]
+            if opt.max_memory is not None:
+                args = args + ['--max_memory', opt.max_memory]
+            results = bench_pipeline(input, opt.pipeline.split(','), args, serving)
+        print('engine  images  images/sec  peak RSS  worker peak RSS')
+        for engine, profile, peak, worker_peak in results:
+            print(f"{engine:>6}  {profile['images']:>6}  {profile['images_per_second']:>10.1f}  {peak}  {worker_peak}")
+        print('\nengine  stage          count    p50 ms    p95 ms    p99 ms')
+        for engine, profile, peak, worker_peak in results:
+            for stage, times in profile['stages'].items():
+                print(f"{engine:>6}  {stage:<13}  {times['count']:>5}  {times['p50_ms']:>8.2f}  {times['p95_ms']:>8.2f}  {times['p99_ms']:>8.2f}")
+        if opt.max_memory is not None:
+            print('\nengine  budget MB  peak RSS MB  held back  seconds held back')
+            for engine, profile, peak, worker_peak in results:
+                budget = profile['memory']
+                if budget is None:
+                    print(f'{engine:>6}  memory could not be measured')
+                    continue
+                print(f"{engine:>6}  {budget['limit'] / 2**20:>9.0f}  {budget['peak_rss'] / 2**20:>11.0f}  {budget['pauses']:>9}  {budget['exceeded_seconds']:>17.1f}")
+        slow = [engine for engine, profile, peak, worker_peak in results if opt.min_rate is not None and profile['images_per_second'] < opt.min_rate]
+        if len(slow) != 0:
+            exit(f"Below {opt.min_rate:g} images/sec: {', '.join(slow)}")
+        over = [engine for engine, profile, peak, worker_peak in results
+                if opt.max_memory is not None and profile['memory'] is not None and profile['memory']['peak_rss'] > profile['memory']['limit']]
+        if len(over) != 0:
+            exit(f"Over the {opt.max_memory} memory budget: {', '.join(over)}")
+        return
+
+    if opt.decode or opt.placements is not None:
+        with tempfile.TemporaryDirectory() as folder:
+            if opt.input is not None:
+                files = [os.path.join(path, file) for path, subdirs, names in os.walk(opt.input) for file in names
+                         if file.lower().endswith(('.jpg', '.jpeg'))][:opt.max_images]
+            else:
+                files = make_fixtures(folder, opt.fixtures or 10, 5472, 3648)
+            if opt.decode:
+                print(f'{len(files)} JPEGs, input_size {opt.input_size}, output_size {opt.output_size}')
+                print('decode  ms/image  peak RSS')
+                for name, ms, peak in bench_decode(files, opt.input_size, opt.output_size):
+                    print(f'{name:>6}  {ms:>8.1f}  {peak}')
+            else:
+                print(f'{len(files)} JPEGs, {sum(os.path.getsize(file) for file in files)} bytes')
+                print('placement  ms/image  bytes written')
+                for placement, ms, written in bench_placements(files, opt.placements.split(',')):
+                    print(f'{placement:>9}  {ms:>8.1f}  {written:>13}')
+        return
+
+    if opt.input is None or opt.model is None:
+        exit('--input and --model are needed unless running --decode')
+    images = load_images(opt.input, opt.input_size, opt.max_images)
+    if len(images) == 0:
+        exit('No images found')
+    # One request up front so model loading is not counted against the first batch size
+    inference.predict(images[:1], opt.model, opt.transport)
+
+    if opt.replicas is not None:
+        manager = containers.ContainerManager(docker.from_env(), opt.org) if opt.org is not None else None
+        print(f'{len(images)} images at {opt.input_size}x{opt.input_size}, batch size {opt.batch_size}, {opt.concurrency} requests in flight')
+        print('replicas  images/sec')
+        for replicas, rate in bench_replicas(images, opt.model, [int(i) for i in opt.replicas.split(',')], opt.batch_size,
+                                             opt.concurrency, opt.transport, manager):
+            print(f'{replicas:>8}  {rate:>10.1f}')
+        return
+
+    batch_sizes = [int(i) for i in opt.batch_sizes.split(',')]
+    print(f'{len(images)} images at {opt.input_size}x{opt.input_size}')
+    print('batch_size  images/sec')
+    for batch_size, rate in bench_batch_sizes(images, opt.model, batch_sizes, opt.transport):
+        print(f'{batch_size:>10}  {rate:>10.1f}')
+
+    if opt.transports is not None:
+        print('\n transport  bytes/image  client CPU ms/image')
+        for transport, wire_bytes, cpu_ms in bench_transports(images, opt.model, opt.transports.split(',')):
+            print(f'{transport:>10}  {wire_bytes:>11.0f}  {cpu_ms:>19.2f}')
+
+
+if __name__ == '__main__':
+    run()
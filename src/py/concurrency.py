@@ -0,0 +1,85 @@
+## How many inference requests are in flight at once, tuned to what the model server keeps up with
+import math
+import multiprocessing
+
+# Fields of the shared state
+LIMIT, IN_FLIGHT, COUNT, LATENCY, FAILURES, BASELINE, SLOW_START, LOWEST, HIGHEST, DECREASES = range(10)
+
+
+class AdaptiveLimit:
+    """A limit on requests in flight shared by every worker process, tuned AIMD style from request latencies.
+    Requests are looked at in windows of about one limit's worth. While a window's mean latency stays within
+    tolerance times the lowest seen, the server isn't queueing requests yet and there is throughput to gain:
+    the limit doubles every window to start with, then grows by one. Once latency goes over that, or a
+    replica fails, the limit is cut to decrease times itself and only grows by one from then on.
+    That keeps the server busy without requests piling up into timeouts.
+    With adaptive=False it is a plain fixed limit"""
+
+    def __init__(self, initial=2, maximum=64, minimum=1, adaptive=True, tolerance=2.0, decrease=0.7, window=4):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.window = window
+        self.condition = multiprocessing.Condition()
+        self.state = multiprocessing.RawArray('d', 10)
+        initial = max(minimum, min(initial, maximum))
+        self.state[LIMIT] = initial
+        self.state[SLOW_START] = 1
+        self.state[LOWEST] = initial
+        self.state[HIGHEST] = initial
+
+    def acquire(self, block=True):
+        """Take a request slot, waiting for one if block, otherwise returning False if there are none"""
+        with self.condition:
+            while self.state[IN_FLIGHT] >= self.state[LIMIT]:
+                if not block:
+                    return False
+                self.condition.wait()
+            self.state[IN_FLIGHT] += 1
+            return True
+
+    def release(self, seconds, failed=False):
+        """Give a slot back, with how long its request took and whether the server failed it"""
+        with self.condition:
+            state = self.state
+            state[IN_FLIGHT] -= 1
+            if self.adaptive:
+                state[COUNT] += 1
+                state[LATENCY] += seconds
+                state[FAILURES] += 1 if failed else 0
+                if state[COUNT] >= max(state[LIMIT], self.window):
+                    self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        state = self.state
+        mean = state[LATENCY] / state[COUNT]
+        # The baseline creeps up a little each window, so a server that got slower for good is re-learnt
+        state[BASELINE] = mean if state[BASELINE] == 0 else min(state[BASELINE] * 1.001, mean)
+        if state[FAILURES] != 0 or mean > state[BASELINE] * self.tolerance:
+            state[LIMIT] = max(self.minimum, math.floor(state[LIMIT] * self.decrease))
+            state[SLOW_START] = 0
+            state[DECREASES] += 1
+        elif state[SLOW_START]:
+            state[LIMIT] = min(self.maximum, state[LIMIT] * 2)
+        else:
+            state[LIMIT] = min(self.maximum, state[LIMIT] + 1)
+        state[LOWEST] = min(state[LOWEST], state[LIMIT])
+        state[HIGHEST] = max(state[HIGHEST], state[LIMIT])
+        state[COUNT] = 0
+        state[LATENCY] = 0
+        state[FAILURES] = 0
+
+    def limit(self):
+        return int(self.state[LIMIT])
+
+    def in_flight(self):
+        return int(self.state[IN_FLIGHT])
+
+    def stats(self):
+        with self.condition:
+            return {'adaptive': self.adaptive, 'limit': int(self.state[LIMIT]), 'maximum': self.maximum,
+                    'lowest': int(self.state[LOWEST]), 'highest': int(self.state[HIGHEST]),
+                    'decreases': int(self.state[DECREASES]), 'baseline_ms': round(self.state[BASELINE] * 1000, 1)}
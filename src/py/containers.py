@@ -0,0 +1,175 @@
+## Managing the sentinel TF Serving container. A running container is reused across runs when it already
+## serves the current image with the same model config, instead of being killed and started again
+import hashlib
+import logging
+import os
+import platform
+import docker
+import inference
+import metadata
+import utils
+
+logger = logging.getLogger('first_logger')
+
+CONTAINER_NAME = 'sentinel'
+REGISTRY = 'us-west2-docker.pkg.dev/sentinel-project-278421'
+# With the app's other runtime files, since the install folder may not be writable. Bind mounted into the containers
+CONFIG_DIR = os.getcwd() + "\\src\\py\\serving"
+CONFIG_FILE = 'models.config'
+CONFIG_LABEL = 'sentinel.config'
+
+
+def image_name(org):
+    return '{}/{}/{}'.format(REGISTRY, org, org)
+
+
+def model_config(models, base_path='/models'):
+    """A TF Serving model config (text protobuf) serving every model in models from base_path/<model>"""
+    entries = ''.join("  config {{\n    name: '{0}'\n    base_path: '{1}/{0}'\n    model_platform: 'tensorflow'\n  }}\n".format(model, base_path)
+                      for model in models)
+    return 'model_config_list {\n' + entries + '}\n'
+
+
+def replica_name(replica):
+    return CONTAINER_NAME if replica == 0 else '{}-{}'.format(CONTAINER_NAME, replica)
+
+
+def cpusets(replicas, cpus):
+    """Split cpus into one contiguous cpuset per replica, e.g. 4 replicas of 32 CPUs -> '0-7', '8-15', ...
+    A single replica isn't pinned"""
+    if replicas == 1:
+        return [None]
+    size = max(cpus // replicas, 1)
+    starts = [(i * size) % cpus for i in range(replicas)]
+    return [str(start) if size == 1 else '{}-{}'.format(start, start + size - 1) for start in starts]
+
+
+def login(key):
+    if platform.system() == 'Windows':
+        query = f'docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev < {key}'
+    else:
+        query = f'cat {key} | docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev'
+    os.system(query)
+
+
+class ContainerManager:
+    """Finds or starts the sentinel container for an org's image, or several replicas of it
+    (sentinel, sentinel-1, ...) pinned to their own CPUs and listening on their own ports.
+    All of the image's models are served at once through a model config file,
+    so switching models never needs a restart"""
+
+    def __init__(self, client, org, cpu_count=None, mem_limit='5g', key=None, config_dir=CONFIG_DIR):
+        self.client = client
+        self.name = image_name(org)
+        self.cpu_count = cpu_count
+        self.mem_limit = mem_limit
+        self.key = key if key is not None else f'{org}.json'
+        self.config_dir = config_dir
+
+    def local_image(self):
+        try:
+            return self.client.images.get(self.name)
+        except docker.errors.ImageNotFound:
+            return None
+
+    def is_current(self, image):
+        """True if the registry's digest for the image matches the local copy. Also true when the registry can't be reached"""
+        try:
+            remote = self.client.images.get_registry_data(self.name).id
+        except docker.errors.APIError as e:
+            logger.warning(f'Could not check {self.name} for updates: {e}')
+            return True
+        return any(digest.endswith('@' + remote) for digest in image.attrs.get('RepoDigests') or [])
+
+    def pull(self):
+        try:
+            return self.client.images.pull(self.name)
+        except docker.errors.APIError as e:
+            # Usually not logged in to the registry yet
+            logger.warning(e)
+            if os.path.exists(self.key):
+                logger.info('Key Found!')
+            login(self.key)
+            return self.client.images.pull(self.name)
+
+    def ensure_image(self):
+        """The local image, pulled first only if it is missing or out of date"""
+        image = self.local_image()
+        if image is None:
+            logger.warning(f'Pulling {self.name}')
+            return self.pull()
+        if utils.connect() and not self.is_current(image):
+            logger.warning(f'Pulling a newer {self.name}')
+            return self.pull()
+        return image
+
+    def find(self, name=CONTAINER_NAME):
+        try:
+            return self.client.containers.get(name)
+        except docker.errors.NotFound:
+            return None
+
+    def reusable(self, container, image, config, cpuset=None):
+        if container.image.id != image.id:
+            return False
+        if (container.attrs['HostConfig'].get('CpusetCpus') or None) != cpuset:
+            return False
+        if container.labels.get(CONFIG_LABEL) != hashlib.sha1(config.encode()).hexdigest():
+            return False
+        if container.status != 'running':
+            return False
+        health = container.attrs['State'].get('Health')
+        return health is None or health.get('Status') != 'unhealthy'
+
+    def write_config(self, config):
+        os.makedirs(self.config_dir, exist_ok=True)
+        with open(os.path.join(self.config_dir, CONFIG_FILE), 'w') as file:
+            file.write(config)
+
+    def start(self, image, config, replica=0, cpuset=None):
+        self.write_config(config)
+        port = inference.replica_ports(replica + 1)[replica]
+        return self.client.containers.run(image.id, detach=True, name=replica_name(replica), ports={8501: port, 8500: port - 1},
+                                          cpu_count=self.cpu_count if cpuset is None else None, cpuset_cpus=cpuset, mem_limit=self.mem_limit,
+                                          volumes={self.config_dir: {'bind': '/config', 'mode': 'ro'}},
+                                          command=[f'--model_config_file=/config/{CONFIG_FILE}'],
+                                          labels={CONFIG_LABEL: hashlib.sha1(config.encode()).hexdigest()})
+
+    def ensure(self, model=None):
+        """A running container serving the image's AVAILABLE_MODELS (plus model, if given), reusing the existing one if it matches"""
+        return self.ensure_replicas(model, 1)[0]
+
+    def ensure_replicas(self, model=None, replicas=1):
+        """replicas running containers, replica i serving REST on inference.replica_ports(replicas)[i] and gRPC on the port below.
+        Each is reused if it already matches, and replicas left over from a bigger earlier run are removed"""
+        image = self.ensure_image()
+        models = list(metadata.available_models(image))
+        if model is not None and model not in models:
+            models.append(model)
+        # The models live wherever the image's entrypoint would have served them from
+        config = model_config(models, metadata.image_env(image).get('MODEL_BASE_PATH', '/models'))
+        started = []
+        for replica, cpuset in enumerate(cpusets(replicas, os.cpu_count())):
+            container = self.find(replica_name(replica))
+            if container is not None:
+                if self.reusable(container, image, config, cpuset):
+                    logger.warning(f'Reusing running container {container.name} ({container.short_id})')
+                    started.append(container)
+                    continue
+                logger.warning(f'Replacing container {container.name} ({container.short_id})')
+                container.remove(force=True)
+            logger.warning(f'Starting {self.name} as {replica_name(replica)} serving {",".join(models)}' + (f' on CPUs {cpuset}' if cpuset else ''))
+            started.append(self.start(image, config, replica, cpuset))
+        self.remove_extra(replicas)
+        return started
+
+    def remove_extra(self, replicas):
+        for container in self.client.containers.list(all=True, filters={'name': CONTAINER_NAME + '-'}):
+            suffix = container.name[len(CONTAINER_NAME) + 1:]
+            if suffix.isdigit() and int(suffix) >= replicas:
+                container.remove(force=True)
+
+    def stop(self):
+        for container in self.client.containers.list(all=True, filters={'name': CONTAINER_NAME}):
+            if container.name == CONTAINER_NAME or container.name.startswith(CONTAINER_NAME + '-'):
+                container.remove(force=True)
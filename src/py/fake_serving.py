@@ -0,0 +1,134 @@
+## A stand-in for TF Serving's REST API, for running and benchmarking the pipeline without the org model images.
+## Answers model status, metadata and predict requests, the predictions shaped like the real detection models'
+## output_0 (boxes in input pixels), output_1 (scores) and output_2 (1-based class ids), after a set delay
+## e.g. python fake_serving.py --port 8501 --latency 0.02 --image_latency 0.002 --detections 1.5
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import inference
+
+
+def fake_predictions(count, input_size, rng, detections=1.0, classes=2, slots=20):
+    """count images' worth of predictions. Each image gets a Poisson number (mean detections) of confident boxes,
+    and the rest of its slots are filled with boxes scoring too low to pass any sensible threshold"""
+    predictions = []
+    for _ in range(count):
+        found = min(rng.poisson(detections), slots)
+        corners = rng.uniform(0, input_size, (slots, 2, 2))
+        boxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+        scores = np.concatenate([rng.uniform(0.5, 1.0, found), rng.uniform(0.0, 0.2, slots - found)])
+        predictions.append({'output_0': boxes.round(1).tolist(),
+                            'output_1': scores.round(4).tolist(),
+                            'output_2': rng.integers(1, classes + 1, slots).astype(float).tolist()})
+    return predictions
+
+
+def make_handler(options):
+    # Like TF Serving on a fixed number of cores: only so many requests are worked on at once
+    running = threading.BoundedSemaphore(options['parallel']) if options['parallel'] else None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 3 and parts[:2] == ['v1', 'models']:
+                self.send_json({'model_version_status': [{'version': '1', 'state': 'AVAILABLE',
+                                                          'status': {'error_code': 'OK', 'error_message': ''}}]})
+            elif len(parts) == 4 and parts[:2] == ['v1', 'models'] and parts[3] == 'metadata':
+                self.send_json({'metadata': {'signature_def': {'signature_def': {'serving_default': {'inputs': {'input_tensor': {}}}}}}})
+            else:
+                self.send_json({'error': 'Not found'}, 404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if not self.path.endswith(':predict'):
+                self.send_json({'error': 'Not found'}, 404)
+                return
+            instances = json.loads(body)['instances']
+            # Pixel lists give the input size away, encoded images don't
+            input_size = len(instances[0]) if len(instances) != 0 and isinstance(instances[0], list) else options['input_size']
+            if running is not None:
+                running.acquire()
+            try:
+                time.sleep(options['latency'] + options['image_latency'] * len(instances))
+            finally:
+                if running is not None:
+                    running.release()
+            rng = np.random.default_rng()
+            self.send_json({'predictions': fake_predictions(len(instances), input_size, rng, options['detections'],
+                                                            options['classes'], options['slots'])})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port, options):
+    ThreadingHTTPServer(('localhost', port), make_handler(options)).serve_forever()
+
+
+class FakeServing:
+    """The stand-in server in a process of its own, so answering requests doesn't compete with the caller for the GIL.
+    latency is seconds per request plus image_latency per image in it, and parallel (if set) limits
+    how many requests are answered at once, like a server with that many cores"""
+
+    def __init__(self, port=inference.REST_PORT, latency=0.02, image_latency=0.002, detections=1.0, classes=2, slots=20,
+                 input_size=256, parallel=None):
+        self.port = port
+        self.options = {'latency': latency, 'image_latency': image_latency, 'detections': detections, 'classes': classes,
+                        'slots': slots, 'input_size': input_size, 'parallel': parallel}
+        self.process = None
+
+    def start(self, timeout=10):
+        self.process = multiprocessing.Process(target=serve, args=(self.port, self.options), daemon=True)
+        self.process.start()
+        inference.init_session()
+        inference.wait_until_ready('fake', timeout, port=self.port)
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int,
+                        default=inference.REST_PORT, help='REST port to listen on')
+    parser.add_argument('--latency', type=float,
+                        default=0.02, help='seconds each request takes')
+    parser.add_argument('--image_latency', type=float,
+                        default=0.002, help='extra seconds per image in a request')
+    parser.add_argument('--detections', type=float,
+                        default=1.0, help='mean confident detections per image')
+    parser.add_argument('--classes', type=int,
+                        default=2, help='number of classes detections are spread over')
+    parser.add_argument('--slots', type=int,
+                        default=20, help='boxes in each image\'s output, confident or not')
+    parser.add_argument('--input_size', type=int,
+                        default=256, help='input size assumed for encoded (b64) images')
+    parser.add_argument('--parallel', type=int,
+                        help='most requests answered at once (default no limit)')
+    opt = parser.parse_args()
+    print(f'Serving fake predictions on port {opt.port}')
+    serve(opt.port, {'latency': opt.latency, 'image_latency': opt.image_latency, 'detections': opt.detections,
+                     'classes': opt.classes, 'slots': opt.slots, 'input_size': opt.input_size, 'parallel': opt.parallel})
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,34 @@
+## Decoding images for the model and for the output folder
+from PIL import Image
+
+
+def decode_size(size, input_size, output_size, keep_output):
+    """Smallest size the image has to be decoded at to produce both the model input and the output copy,
+    or None if the output copy needs the full resolution"""
+    w, h = size
+    if not keep_output:
+        return (input_size, input_size)
+    if output_size is None:
+        return None
+    return (max(input_size, int(output_size)), max(input_size, int(int(output_size)/w*h)))
+
+
+def preprocess(filename, input_size, output_size, keep_output=True, draft=True):
+    """Decode an image once and return (model input, output copy).
+    For JPEGs, draft mode lets libjpeg scale down by 1/2, 1/4 or 1/8 while decoding (in the DCT domain),
+    so a 20 MP trail camera image is never decoded at full size just to make a 256x256 tensor.
+    The output copy is None when keep_output is False (output style 'none')"""
+    img = Image.open(filename)
+    w, h = img.size
+    if draft:
+        target = decode_size((w, h), input_size, output_size, keep_output)
+        if target is not None:
+            img.draft(img.mode, target)
+    image = img.resize([input_size,input_size])
+    if not keep_output:
+        image_out = None
+    elif output_size is not None:
+        image_out = img.resize([int(output_size),int(int(output_size)/w*h)])
+    else:
+        image_out = img
+    return image, image_out
@@ -0,0 +1,378 @@
+## Talking to the TF Serving container
+import base64
+import io
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import numpy as np
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import profiling
+
+# gRPC transport is optional (pip install tensorflow-serving-api grpcio)
+try:
+    import grpc
+    from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+    from tensorflow.core.framework import tensor_pb2, tensor_shape_pb2, types_pb2
+except ImportError:
+    grpc = None
+
+TRANSPORTS = ['json', 'b64', 'grpc']
+REST_PORT = 8501
+GRPC_PORT = 8500
+
+_session = None
+_grpc_stubs = {}
+_input_names = {}
+_balancer = None
+_limit = None
+
+
+def make_session(pool_size=1, retries=5, backoff=0.2):
+    """A keep-alive session that retries refused connections and 5xx responses with exponential backoff"""
+    retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                  backoff_factor=backoff, status_forcelist=[500, 502, 503, 504],
+                  allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    return session
+
+
+def init_session(pool_size=1, retries=None, backoff=0.2):
+    """Set up this process's session. Meant to be called once from a Pool initializer.
+    With several replicas, retries default to one, since failing over to another replica is quicker than backing off"""
+    global _session
+    if retries is None:
+        retries = 5 if _balancer is None else 1
+    _session = make_session(pool_size, retries, backoff)
+
+
+def get_session():
+    if _session is None:
+        init_session()
+    return _session
+
+
+def replica_ports(replicas):
+    """REST ports of serving replicas. Replica i listens on REST_PORT + 2i for REST and the port below it for gRPC"""
+    return [REST_PORT + 2 * i for i in range(replicas)]
+
+
+class Balancer:
+    """Sends each request to the replica with the fewest requests outstanding, taking turns between ties.
+    outstanding can be a multiprocessing.Array shared by every worker process, so the counts cover all of them.
+    A replica that refuses connections or answers 5xx is left out for cooldown seconds"""
+
+    def __init__(self, ports, outstanding=None, cooldown=10):
+        self.ports = list(ports)
+        self.outstanding = outstanding if outstanding is not None else multiprocessing.Array('i', len(self.ports))
+        self.cooldown = cooldown
+        self.down_until = [0.0] * len(self.ports)
+        # Start each process at a different replica so idle workers don't all pick the first one
+        self.turn = os.getpid() % len(self.ports)
+
+    def acquire(self):
+        now = time.monotonic()
+        with self.outstanding.get_lock():
+            candidates = [i for i in range(len(self.ports)) if self.down_until[i] <= now]
+            if len(candidates) == 0:
+                # Everything is out of rotation, so try the one that has been out longest
+                candidates = [min(range(len(self.ports)), key=lambda i: self.down_until[i])]
+            replica = min(candidates, key=lambda i: (self.outstanding[i], (i - self.turn) % len(self.ports)))
+            self.outstanding[replica] = self.outstanding[replica] + 1
+        self.turn = (replica + 1) % len(self.ports)
+        return replica
+
+    def release(self, replica, failed=False):
+        with self.outstanding.get_lock():
+            self.outstanding[replica] = self.outstanding[replica] - 1
+        if failed:
+            self.down_until[replica] = time.monotonic() + self.cooldown
+        else:
+            self.down_until[replica] = 0.0
+
+
+def init_replicas(ports, outstanding=None):
+    """Spread this process's requests over several serving replicas. Call before init_session"""
+    global _balancer
+    _balancer = Balancer(ports, outstanding) if len(ports) > 1 else None
+
+
+def acquire_replica():
+    """The replica to send the next request to, or None when there is only the one container"""
+    return _balancer.acquire() if _balancer is not None else None
+
+
+def release_replica(replica, failed=False):
+    if replica is not None:
+        _balancer.release(replica, failed)
+
+
+def replica_port(replica):
+    return _balancer.ports[replica] if replica is not None else REST_PORT
+
+
+def replica_count():
+    return len(_balancer.ports) if _balancer is not None else 1
+
+
+def init_limit(limit):
+    """Hold this process's requests to limit (a concurrency.AdaptiveLimit shared by every worker), or None for no limit"""
+    global _limit
+    _limit = limit
+
+
+def request_limit():
+    return _limit
+
+
+def predict_url(model, host='localhost', port=REST_PORT):
+    return 'http://{}:{}/v1/models/{}:predict'.format(host, port, model)
+
+
+def status_url(model, host='localhost', port=REST_PORT):
+    return 'http://{}:{}/v1/models/{}'.format(host, port, model)
+
+
+def wait_until_ready(model, timeout=120, backoff=0.2, max_backoff=5, port=REST_PORT):
+    """Poll the model status endpoint, backing off exponentially, until a version of model is AVAILABLE.
+    Returns the seconds it took. Raises TimeoutError if the model isn't ready within timeout seconds"""
+    start = time.monotonic()
+    delay = backoff
+    while True:
+        try:
+            response = requests.get(status_url(model, port=port), timeout=5)
+            if response.status_code == 200:
+                states = [version['state'] for version in response.json().get('model_version_status', [])]
+                if 'AVAILABLE' in states:
+                    return time.monotonic() - start
+                last = 'state ' + ','.join(states)
+            else:
+                # 404 while the SavedModel is still being loaded
+                last = 'HTTP {}'.format(response.status_code)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            last = e
+        if time.monotonic() - start + delay > timeout:
+            raise TimeoutError('Model {} on port {} not ready after {}s ({})'.format(model, port, timeout, last))
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+
+def warm_up(model, input_size, transport='json', batch_size=1, batches=2):
+    """Send a few blank batches at the run's input size, so the model's first real images don't pay for
+    graph initialisation. Returns each request's latency in ms"""
+    images = [np.zeros((input_size, input_size, 3), dtype=np.uint8)] * batch_size
+    latencies = []
+    for _ in range(batches):
+        start = time.perf_counter()
+        predict(images, model, transport)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def encode_json(images):
+    """Images as nested lists of pixel values (the original payload)"""
+    im = np.stack([np.array(image) for image in images]).tolist()
+    return json.dumps({"signature_name": "serving_default", "instances": im})
+
+
+def encode_b64(images, quality=95):
+    """Images as base64 JPEG bytes. The model must take encoded image strings as its input"""
+    instances = []
+    for image in images:
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        instances.append({"b64": base64.b64encode(buffer.getvalue()).decode('ascii')})
+    return json.dumps({"signature_name": "serving_default", "instances": instances})
+
+
+def input_name(model):
+    """Name of the serving_default input tensor, which gRPC requests have to address explicitly"""
+    if model not in _input_names:
+        url = 'http://localhost:{}/v1/models/{}/metadata'.format(REST_PORT, model)
+        metadata = get_session().get(url, timeout=30).json()
+        inputs = metadata['metadata']['signature_def']['signature_def']['serving_default']['inputs']
+        _input_names[model] = list(inputs)[0]
+    return _input_names[model]
+
+
+def grpc_request(images, model):
+    """Images as a raw uint8 TensorProto inside a PredictRequest"""
+    if grpc is None:
+        raise ImportError('gRPC transport needs tensorflow-serving-api and grpcio installed')
+    im = np.stack([np.array(image) for image in images]).astype(np.uint8)
+    tensor = tensor_pb2.TensorProto(
+        dtype=types_pb2.DT_UINT8,
+        tensor_shape=tensor_shape_pb2.TensorShapeProto(dim=[tensor_shape_pb2.TensorShapeProto.Dim(size=i) for i in im.shape]),
+        tensor_content=im.tobytes())
+    request = predict_pb2.PredictRequest()
+    request.model_spec.name = model
+    request.model_spec.signature_name = 'serving_default'
+    request.inputs[input_name(model)].CopyFrom(tensor)
+    return request
+
+
+def tensor_to_array(tensor):
+    shape = [dim.size for dim in tensor.tensor_shape.dim]
+    if tensor.dtype == types_pb2.DT_FLOAT:
+        dtype, values = np.float32, tensor.float_val
+    elif tensor.dtype == types_pb2.DT_INT64:
+        dtype, values = np.int64, tensor.int64_val
+    else:
+        dtype, values = np.int32, tensor.int_val
+    if tensor.tensor_content:
+        return np.frombuffer(tensor.tensor_content, dtype=dtype).reshape(shape)
+    return np.array(values, dtype=dtype).reshape(shape)
+
+
+def predict_grpc(images, model, timeout=30, port=GRPC_PORT):
+    with profiling.stage('encode'):
+        request = grpc_request(images, model)
+    if port not in _grpc_stubs:
+        channel = grpc.insecure_channel('localhost:{}'.format(port))
+        _grpc_stubs[port] = prediction_service_pb2_grpc.PredictionServiceStub(channel)
+    with profiling.stage('request'):
+        response = _grpc_stubs[port].Predict(request, timeout)
+    with profiling.stage('parse'):
+        outputs = {name: tensor_to_array(tensor) for name, tensor in response.outputs.items()}
+    # Split the batched output tensors into one dict per image, like the REST response
+    return [{name: values[i].tolist() for name, values in outputs.items()} for i in range(len(images))]
+
+
+def is_replica_failure(e):
+    """Errors that mean the replica itself is in trouble, rather than the request being bad"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    if grpc is not None and isinstance(e, grpc.RpcError):
+        return e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def predict(images, model, transport='json', timeout=30):
+    """Send a list of preprocessed images to TF Serving as a single request.
+    Returns one prediction dict per image, in the same order.
+    With several replicas, a request a replica fails is tried once on each of the others.
+    Waits for a slot first if the requests in flight are limited"""
+    if _limit is None:
+        return predict_replicas(images, model, transport, timeout)
+    _limit.acquire()
+    start = time.perf_counter()
+    failed = False
+    try:
+        return predict_replicas(images, model, transport, timeout)
+    except Exception as e:
+        failed = is_replica_failure(e)
+        raise
+    finally:
+        _limit.release(time.perf_counter() - start, failed)
+
+
+def predict_replicas(images, model, transport='json', timeout=30):
+    attempts = replica_count()
+    for attempt in range(attempts):
+        replica = acquire_replica()
+        try:
+            predictions = predict_on(images, model, transport, timeout, replica_port(replica))
+        except Exception as e:
+            failed = is_replica_failure(e)
+            release_replica(replica, failed)
+            if not failed or attempt == attempts - 1:
+                raise
+            continue
+        release_replica(replica)
+        return predictions
+
+
+def predict_on(images, model, transport='json', timeout=30, port=REST_PORT):
+    if transport == 'grpc':
+        return predict_grpc(images, model, timeout, port - 1)
+    with profiling.stage('encode'):
+        if transport == 'b64':
+            data = encode_b64(images)
+        else:
+            data = encode_json(images)
+    headers = {"content-type": "application/json"}
+    # The round trip: sending, TF Serving running the model, and reading the response
+    with profiling.stage('request'):
+        json_response = get_session().post(predict_url(model, port=port), data=data, headers=headers, timeout=timeout)
+        json_response.raise_for_status()
+    with profiling.stage('parse'):
+        predictions = json.loads(json_response.text)['predictions']
+    if len(predictions) != len(images):
+        raise ValueError(f'Expected {len(images)} predictions, got {len(predictions)}')
+    return predictions
+
+
+def batched(items, batch_size, max_wait=None):
+    """Group an iterable into lists of up to batch_size items.
+    A partial batch is handed on once max_wait seconds have passed since its first item arrived,
+    so a slow producer does not hold back images that are already waiting"""
+    if max_wait is None:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+    # The producer is read on a thread of its own, so the deadline is kept even while it is stalled.
+    # The queue is bounded, so it still isn't read further ahead than a batch
+    waiting = queue.Queue(maxsize=batch_size)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                waiting.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+
+    threading.Thread(target=read, daemon=True).start()
+    batch = []
+    deadline = None
+    try:
+        while True:
+            try:
+                if batch:
+                    is_item, item = waiting.get(timeout=max(deadline - time.monotonic(), 0))
+                else:
+                    is_item, item = waiting.get()
+            except queue.Empty:
+                yield batch
+                batch = []
+                continue
+            if not is_item:
+                break
+            if not batch:
+                deadline = time.monotonic() + max_wait
+            batch.append(item)
+            if len(batch) >= batch_size or time.monotonic() >= deadline:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        if item is not None:
+            raise item
+    finally:
+        stopped.set()
@@ -0,0 +1,220 @@
+## Keeping a run within a memory budget: the memory of this process and its workers is sampled in the background,
+## and batches are handed to the engine through a Dispatcher that holds new ones back while it is too high
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import threading
+import time
+
+# psutil comes with reqs.py. Without it memory use is read from /proc, so only on Linux
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+M_MMAP_THRESHOLD = -3
+MMAP_THRESHOLD = 1024 ** 2
+
+UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """Bytes in a size like 4g, 512m or 1.5G (units of 1024, like docker's mem_limit), or a plain number of bytes"""
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(float(size))
+
+
+def rss(pid):
+    """Resident memory of a process in bytes, or None if it can't be read"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def release_freed_images():
+    """glibc raises its mmap threshold each time a big block is freed, after which image sized buffers come out of
+    the threads' malloc arenas, which hold on to them once freed: each render thread of a worker kept ~50 MB.
+    Fixing the threshold keeps big buffers in mappings of their own, handed back as soon as they are freed.
+    Does nothing where the C library isn't glibc"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.mallopt(M_MMAP_THRESHOLD, MMAP_THRESHOLD)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+def pss(pid):
+    """Memory of a process in bytes counting the pages it shares with other processes only for its share of them
+    (PSS, Linux), or where that isn't known only the pages it has to itself (USS). None if it can't be read"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as file:
+            for line in file:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            info = psutil.Process(pid).memory_full_info()
+        except psutil.Error:
+            return None
+        return getattr(info, 'pss', None) or getattr(info, 'uss', None)
+    return None
+
+
+def tree_memory():
+    """Memory of this process and its worker processes added up. Workers share the pages they were forked with,
+    so where it can be read each process's share of them (PSS) is counted rather than its RSS,
+    which would count them once per process and put a run with many workers over its budget before it starts"""
+    total = pss(os.getpid())
+    measure = pss if total is not None else rss
+    if total is None:
+        total = rss(os.getpid())
+    if total is None:
+        return None
+    for child in multiprocessing.active_children():
+        total = total + (measure(child.pid) or 0)
+    return total
+
+
+def measurable():
+    """Whether memory use can be read on this machine, with psutil or from /proc"""
+    return tree_memory() is not None
+
+
+class MemoryBudget:
+    """Samples tree_memory() every interval seconds from a background thread. The budget counts as exceeded once
+    memory goes over high (a share of limit, leaving room for the batches already under way) until it drops back
+    under low, so work doesn't stop and start on every sample. pauses counts the times a Dispatcher cut back for it"""
+
+    def __init__(self, limit, interval=0.1, high=0.9, low=0.8):
+        self.limit = limit
+        self.interval = interval
+        self.high = high * limit
+        self.low = low * limit
+        self.exceeded = False
+        self.current = 0
+        self.peak = 0
+        self.window_peak = 0
+        self.pauses = 0
+        self.exceeded_seconds = 0.0
+        if not measurable():
+            raise RuntimeError('Memory use can not be measured here, so there is no keeping to --max_memory (pip install psutil)')
+        self.sample()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        current = tree_memory()
+        if current is None:
+            return
+        self.current = current
+        self.peak = max(self.peak, current)
+        self.window_peak = max(self.window_peak, current)
+        if not self.exceeded and current > self.high:
+            self.exceeded = True
+            self.exceeded_since = time.monotonic()
+        elif self.exceeded and current < self.low:
+            self.exceeded = False
+            self.exceeded_seconds = self.exceeded_seconds + time.monotonic() - self.exceeded_since
+
+    def take_peak(self):
+        """The highest memory use since the last call (or the latest sample, if there hasn't been one since)"""
+        peak = max(self.window_peak, self.current)
+        self.window_peak = 0
+        return peak
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.exceeded:
+            self.exceeded = False
+            self.exceeded_seconds = self.exceeded_seconds + time.monotonic() - self.exceeded_since
+
+    def stats(self):
+        return {'limit': self.limit, 'peak_rss': self.peak, 'pauses': self.pauses, 'exceeded_seconds': round(self.exceeded_seconds, 3)}
+
+
+class Dispatcher:
+    """Hands batches on to an engine no faster than their results come back: at most max_pending out at once.
+    With a budget (a MemoryBudget) it starts with one batch out and, like slow start, lets one more out
+    for each batch that finishes while there was still room under the budget's high mark for another batch
+    (the most memory use dropped by as a batch finished) over the last allowed batches' time out,
+    halving that whenever it went over the high mark.
+    Batches held back while there is no room count as the budget's pauses. Memory is only seen after batches
+    have been taken on, so growing gradually keeps the overshoot to about a batch's worth, rather than
+    every batch let out at once before the first sample.
+    One batch is always let through, so a budget set too low slows the run down rather than stopping it.
+    Engines pull batches from feed() (a Pool's task thread, say) and the caller calls done() for each result.
+    max_pending can also be a function, for a limit that changes during the run"""
+
+    def __init__(self, max_pending, budget=None):
+        self.max_pending = max_pending
+        self.budget = budget
+        self.allowed = 1
+        self.batch_bytes = 0
+        self.peaks = []
+        self.room = True
+        self.pending = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def limit(self):
+        return self.max_pending() if callable(self.max_pending) else self.max_pending
+
+    def held_for_budget(self):
+        return self.budget is not None and self.allowed <= self.pending < self.limit()
+
+    def blocked(self):
+        return self.pending >= self.limit() or self.held_for_budget()
+
+    def feed(self, batches):
+        for batch in batches:
+            with self.condition:
+                if not self.room and self.held_for_budget():
+                    self.budget.pauses = self.budget.pauses + 1
+                # Woken by done(), and checking every so often for max_pending changing
+                while not self.closed and self.blocked():
+                    self.condition.wait(0.1)
+                if self.closed:
+                    return
+                self.pending = self.pending + 1
+            yield batch
+
+    def done(self):
+        with self.condition:
+            self.pending = self.pending - 1
+            if self.budget is not None:
+                peak = self.budget.take_peak()
+                # The batch's images are freed by the time its results are back
+                self.batch_bytes = max(self.batch_bytes, peak - (tree_memory() or peak))
+                # Results can come back a few at once, each after only a moment's sampling, so look at the whole round
+                self.peaks = (self.peaks + [peak])[-self.allowed:]
+                self.room = not self.budget.exceeded and max(self.peaks) + self.batch_bytes < self.budget.high
+                if self.budget.exceeded or peak > self.budget.high:
+                    self.allowed = max(self.allowed // 2, 1)
+                elif self.room:
+                    self.allowed = min(self.allowed + 1, self.limit())
+            self.condition.notify_all()
+
+    def close(self):
+        """Stop feeding, e.g. so a Pool being terminated isn't left waiting on feed()"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
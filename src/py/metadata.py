@@ -0,0 +1,63 @@
+## Model metadata (the available models and their class names) read from the environment baked into
+## an org's image, so no container has to be started to find it. Cached on disk by image digest
+import json
+import os
+
+# With the app's other runtime files, since the install folder may not be writable
+CACHE_PATH = os.getcwd() + "\\src\\py\\metadata_cache.json"
+
+
+def image_env(image):
+    """The environment baked into an image, as a dict"""
+    env = image.attrs['Config'].get('Env') or []
+    return dict(item.split('=', 1) for item in env if '=' in item)
+
+
+def image_digest(image):
+    """The registry digest the image was pulled as, or its local ID for images that were never pulled"""
+    for digest in image.attrs.get('RepoDigests') or []:
+        return digest.split('@')[-1]
+    return image.id
+
+
+def parse_env(env):
+    """{'models': [...], 'classes': {model: 'name,name'}} from AVAILABLE_MODELS and <MODEL>_CLASSES"""
+    models = [name for name in env.get('AVAILABLE_MODELS', '').split(',') if name]
+    classes = {key[:-len('_CLASSES')]: value.replace(',???', '') for key, value in env.items() if key.endswith('_CLASSES')}
+    return {'models': models, 'classes': classes}
+
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, path=CACHE_PATH):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(cache, file, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def image_metadata(image, cache_path=CACHE_PATH):
+    """The image's models and class names, from the cache when this digest has been read before"""
+    digest = image_digest(image)
+    cache = load_cache(cache_path)
+    if digest not in cache:
+        cache[digest] = parse_env(image_env(image))
+        # The cache only saves reading the image again, so a run doesn't fail over it
+        try:
+            save_cache(cache, cache_path)
+        except OSError:
+            pass
+    return cache[digest]
+
+
+def class_names(image, model):
+    return image_metadata(image)['classes'][model.upper()]
+
+
+def available_models(image):
+    return image_metadata(image)['models']
@@ -0,0 +1,110 @@
+## Live metrics for long unattended runs, served over HTTP in the Prometheus text format
+## (scrape http://localhost:<port>/metrics). Only needs the standard library
+import bisect
+import functools
+import http.server
+import multiprocessing
+import threading
+import profiling
+
+# Upper bounds of the stage latency buckets, in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'sentinel_'
+
+
+def stage_histograms():
+    """Stage latency histograms shared by every worker process: for each of profiling.STAGES,
+    a count per bucket (the last one +Inf) followed by the sum of the durations"""
+    return multiprocessing.Array('d', len(profiling.STAGES) * (len(BUCKETS) + 2))
+
+
+def observer(histograms):
+    """A profiling observer adding each timing to the shared histograms"""
+    width = len(BUCKETS) + 2
+    starts = {name: i * width for i, name in enumerate(profiling.STAGES)}
+
+    def observe(name, seconds):
+        start = starts.get(name)
+        if start is None:
+            return
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with histograms.get_lock():
+            histograms[start + bucket] += 1
+            histograms[start + width - 1] += seconds
+    return observe
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels.items()) + '}'
+
+
+def exposition(families, histograms=None):
+    """The text format for families, a list of (name, type, help, samples) where samples is a list of (labels, value),
+    plus the stage latency histograms if given"""
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f'# HELP {PREFIX}{name} {help}')
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+    if histograms is not None:
+        with histograms.get_lock():
+            values = histograms[:]
+        width = len(BUCKETS) + 2
+        name = PREFIX + 'stage_seconds'
+        lines.append(f'# HELP {name} Time spent in each stage of the pipeline, across all worker processes')
+        lines.append(f'# TYPE {name} histogram')
+        for i, stage in enumerate(profiling.STAGES):
+            counts = values[i * width:(i + 1) * width - 1]
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ['+Inf'], counts):
+                cumulative = cumulative + int(count)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {values[(i + 1) * width - 1]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def __init__(self, render, *args, **kwargs):
+        self.render = render
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the console
+        pass
+
+
+class MetricsServer:
+    """Serves render() at /metrics from a background thread. Port 0 picks a free port"""
+
+    def __init__(self, render, port, host='127.0.0.1'):
+        self.server = http.server.ThreadingHTTPServer((host, port), functools.partial(Handler, render))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/metrics'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,43 @@
+## Non-maximum suppression of overlapping detections (the Python side of src/main/SentinelDesktopService/nms.ts)
+import numpy as np
+
+DEFAULT_IOU_THRESHOLD = 0.3
+DEFAULT_MAX_PREDICTIONS = 20
+MODES = ['agnostic', 'class', 'none']
+
+
+def iou(box, boxes):
+    """Intersection-over-union of one [ymin, xmin, ymax, xmax] box against an (N, 4) array of boxes"""
+    height = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+    width = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+    intersection = np.maximum(0, height) * np.maximum(0, width)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area + areas - intersection
+    return np.divide(intersection, union, out=np.zeros_like(union), where=union > 0)
+
+
+def nms_indices(boxes, scores, iou_threshold=DEFAULT_IOU_THRESHOLD, max_predictions=DEFAULT_MAX_PREDICTIONS, class_ids=None):
+    """Greedy NMS. Returns the indexes of the boxes to keep, highest score first.
+    With class_ids, boxes only suppress boxes of the same class"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if class_ids is not None and len(boxes) != 0:
+        # Shift each class into its own region of space so boxes of different classes never overlap
+        offset = (boxes.max() - boxes.min() + 1) * np.asarray(class_ids, dtype=np.float64)
+        boxes = boxes + offset[:, None]
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    keep = []
+    while len(order) != 0 and len(keep) < max_predictions:
+        top = order[0]
+        keep.append(top)
+        rest = order[1:]
+        order = rest[iou(boxes[top], boxes[rest]) <= iou_threshold]
+    return np.array(keep, dtype=np.intp)
+
+
+def suppress(detections, mode='agnostic', iou_threshold=DEFAULT_IOU_THRESHOLD, max_predictions=DEFAULT_MAX_PREDICTIONS):
+    """Apply NMS to a structured array of detections (see postprocessing.DETECTION_DTYPE)"""
+    if mode == 'none' or len(detections) == 0:
+        return detections
+    class_ids = detections['class_id'] if mode == 'class' else None
+    return detections[nms_indices(detections['bbox'], detections['confidence'], iou_threshold, max_predictions, class_ids)]
@@ -0,0 +1,69 @@
+## Turning raw model outputs into detections
+import os
+import numpy as np
+
+# One row per detection. bbox is [ymin, xmin, ymax, xmax] as a fraction of the image size
+DETECTION_DTYPE = np.dtype([
+    ('class_id', np.int32),
+    ('class_name', object),
+    ('confidence', np.float64),
+    ('bbox', np.float64, (4,)),
+])
+
+EMPTY_CLASS = 'blank'
+ERROR_CLASS = 99
+
+
+def parse_class_thresholds(class_thresh):
+    """'rat=60,cat=50' -> {'rat': 0.6, 'cat': 0.5}. Thresholds are 0-100 like --thresh"""
+    if not class_thresh:
+        return {}
+    thresholds = {}
+    for item in class_thresh.split(','):
+        name, value = item.split('=')
+        thresholds[name.strip()] = float(value) / 100
+    return thresholds
+
+
+def decode_predictions(predictions, input_size, class_names, threshold, class_thresholds=None, top_k=None):
+    """Convert one image's output_0/1/2 into a structured array of the detections above threshold,
+    highest confidence first. class_thresholds optionally overrides threshold per class name"""
+    boxes = np.asarray(predictions['output_0'], dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(predictions['output_1'], dtype=np.float64).reshape(-1)
+    class_ids = np.asarray(predictions['output_2'], dtype=np.float64).reshape(-1).astype(np.int32)
+    count = min(len(boxes), len(scores), len(class_ids))
+    boxes, scores, class_ids = boxes[:count], scores[:count], class_ids[:count]
+
+    # Class ids are 1-based indexes into class_names
+    names = np.asarray(list(class_names) + ['unknown'], dtype=object)
+    valid = (class_ids >= 1) & (class_ids <= len(class_names))
+    name_index = np.where(valid, class_ids - 1, len(class_names))
+
+    if class_thresholds:
+        class_limits = np.array([class_thresholds.get(name, threshold) for name in names])
+        limits = class_limits[name_index]
+    else:
+        limits = threshold
+    keep = np.flatnonzero(scores > limits)
+    keep = keep[np.argsort(-scores[keep], kind='stable')]
+    if top_k is not None:
+        keep = keep[:top_k]
+
+    detections = np.empty(len(keep), dtype=DETECTION_DTYPE)
+    detections['class_id'] = class_ids[keep]
+    detections['class_name'] = names[name_index[keep]]
+    detections['confidence'] = scores[keep]
+    detections['bbox'] = boxes[keep] / input_size
+    return detections
+
+
+def rows(filename, detections):
+    """Output rows for one image (see sinks.FIELDS): one per detection, a blank row if there are none,
+    or an error row if detections is None. Blank and error rows have NaN boxes"""
+    basename = os.path.basename(filename)
+    if detections is None:
+        return [(basename,ERROR_CLASS,0,0.0,filename,np.nan,np.nan,np.nan,np.nan)]
+    if len(detections) == 0:
+        return [(basename,EMPTY_CLASS,0,0.0,filename,np.nan,np.nan,np.nan,np.nan)]
+    return [(basename,detection['class_name'],int(detection['class_id']),float(detection['confidence']),filename,*detection['bbox'].tolist())
+            for detection in detections]
@@ -0,0 +1,194 @@
+## Per-stage timing of the processing hot path (decode, encode, request, postprocess, draw, save, ...),
+## gathered from every worker process into profile.json, and an opt-in cProfile hook
+import bisect
+import cProfile
+import glob
+import json
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds, 10us to 1000s, each about 5% above the last
+BOUNDS = [1e-5 * 1.05 ** i for i in range(378)]
+PROFILE_FILE = 'profile.json'
+PROFILE_DIR = 'profile'
+# The stages the pipeline times, in the order they happen
+STAGES = ['decode', 'encode', 'request', 'parse', 'postprocess', 'render_wait', 'output_decode', 'draw', 'save', 'place',
+          'write', 'checkpoint']
+
+enabled = True
+_histograms = {}
+_lock = threading.Lock()
+_profiler = None
+_observer = None
+
+
+class Histogram:
+    """Counts of durations in BOUNDS buckets. Histograms from different processes merge by adding counts,
+    and percentiles come back as the upper bound of their bucket, so to within 5%"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count = self.count + other.count
+        self.total = self.total + other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= rank and count != 0:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'counts': {i: count for i, count in enumerate(self.counts) if count != 0},
+                'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for i, count in data['counts'].items():
+            histogram.counts[int(i)] = count
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.max = data['max']
+        return histogram
+
+    def summary(self):
+        return {'count': self.count, 'total_seconds': round(self.total, 3),
+                'mean_ms': round(self.total / self.count * 1000, 3) if self.count != 0 else 0.0,
+                'p50_ms': round(self.percentile(50) * 1000, 3), 'p95_ms': round(self.percentile(95) * 1000, 3),
+                'p99_ms': round(self.percentile(99) * 1000, 3), 'max_ms': round(self.max * 1000, 3)}
+
+
+class Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = NoStage()
+
+
+def stage(name):
+    """with profiling.stage('decode'): ... adds the time taken to that stage's histogram. Does nothing when disabled"""
+    if not enabled:
+        return _NO_STAGE
+    return Stage(name)
+
+
+def record(name, seconds):
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+    if _observer is not None:
+        _observer(name, seconds)
+
+
+def observe(function):
+    """Also pass every timing to function(name, seconds), e.g. for live metrics. None stops it"""
+    global _observer
+    _observer = function
+
+
+def configure(timers=True, cprofile=False):
+    """Set up this process's timers, and start cProfile if asked. Meant to be called once per process"""
+    global enabled, _profiler
+    enabled = timers
+    if cprofile and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def reset(folder=None):
+    """Forget this process's timings, and any worker timings an interrupted run left in folder"""
+    with _lock:
+        _histograms.clear()
+    if folder is not None:
+        for path in glob.glob(os.path.join(folder, 'stages-*.json')):
+            os.remove(path)
+
+
+def dump(folder):
+    """Save this process's histograms (and cProfile stats, if running) into folder for the main process to collect.
+    Called as each worker process exits"""
+    os.makedirs(folder, exist_ok=True)
+    if _profiler is not None:
+        _profiler.disable()
+        # Readable with pstats, snakeviz, or anything else that reads cProfile output
+        _profiler.dump_stats(os.path.join(folder, f'cprofile-{os.getpid()}.prof'))
+    with _lock:
+        stages = {name: histogram.to_dict() for name, histogram in _histograms.items()}
+    with open(os.path.join(folder, f'stages-{os.getpid()}.json'), 'w') as file:
+        json.dump(stages, file)
+
+
+def collect(folder):
+    """This process's histograms merged with those every worker dumped into folder. The worker files are removed"""
+    merged = {}
+    with _lock:
+        for name, histogram in _histograms.items():
+            merged[name] = Histogram()
+            merged[name].merge(histogram)
+    pids = [os.getpid()]
+    for path in glob.glob(os.path.join(folder, 'stages-*.json')):
+        with open(path) as file:
+            stages = json.load(file)
+        pids.append(int(os.path.basename(path)[len('stages-'):-len('.json')]))
+        for name, data in stages.items():
+            merged.setdefault(name, Histogram()).merge(Histogram.from_dict(data))
+        os.remove(path)
+    return merged, pids
+
+
+def write_profile(path, folder, run_info):
+    """Write run_info plus a latency summary per stage, across this process and the workers that dumped into folder, to path"""
+    if _profiler is not None:
+        dump(folder)
+    histograms, pids = collect(folder)
+    profile = dict(run_info)
+    profile['pids'] = pids
+    profile['stages'] = {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+    with open(path + '.tmp', 'w') as file:
+        json.dump(profile, file, indent=4)
+    os.replace(path + '.tmp', path)
+    if os.path.isdir(folder) and len(os.listdir(folder)) == 0:
+        os.rmdir(folder)
+    return profile
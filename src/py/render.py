@@ -0,0 +1,205 @@
+## Drawing detections onto the output copies and saving them, off the inference path
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from PIL import Image, ImageDraw
+import profiling
+
+# Copy-on-write clones are Linux only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('first_logger')
+
+_STOP = object()
+
+PLACEMENTS = ['reflink', 'copy', 'link', 'encode']
+FICLONE = 0x40049409
+
+
+def copy_range(src_file, dst_file):
+    size = os.fstat(src_file.fileno()).st_size
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), size - offset)
+        if copied == 0:
+            break
+        offset = offset + copied
+
+
+def place_file(src, dst, placement='reflink'):
+    """Put an unmodified copy of src at dst without decoding it.
+    reflink clones the file's blocks where the filesystem allows it (btrfs, xfs, APFS via copyfile),
+    link hard links it (same file, no extra space), copy is a plain kernel-side copy.
+    Each falls back to a plain copy when it isn't possible"""
+    if os.path.exists(dst):
+        # Output folder is the input folder: the file is already in place, and removing dst would remove src
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    if placement == 'link':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if placement == 'reflink' and fcntl is not None:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                return
+            except OSError:
+                pass
+            try:
+                copy_range(src_file, dst_file)
+                return
+            except (OSError, AttributeError):
+                pass
+    # Uses sendfile on Linux and fcopyfile on macOS
+    shutil.copyfile(src, dst)
+
+
+def draw_detections(image_out, detections):
+    width_out, height_out = image_out.size
+    draw = ImageDraw.Draw(image_out)
+    for detection in detections:
+        # Draw bounding_box
+        bbox = detection['bbox']
+        draw.rectangle([(bbox[1]*width_out,bbox[0]*height_out),(bbox[3]*width_out,bbox[2]*height_out)],outline='red',width=3)
+
+        # Draw label and score
+        result_text = str(detection['class_name']) + ' (' + str(detection['confidence']) + ')'
+        draw.text((bbox[1] + 10, bbox[0] + 10),result_text,fill='red')
+
+
+class Saving:
+    """Handed back by Renderer.submit(). wait() returns once the job is finished, with whether its image was saved"""
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.saved = False
+
+    def wait(self):
+        self.finished.wait()
+        return self.saved
+
+
+class Renderer:
+    """A bounded queue of (image, detections, path) jobs drawn and saved by a few threads.
+    submit() blocks while the queue is full, so the time callers spend stalled there shows when saving can't keep up.
+    It returns a Saving to wait on, so a file isn't reported done before its output copy is written.
+    Jobs without an image are placed straight from the source file, unless they need boxes drawn
+    or resizing to output_size, in which case the source is decoded here.
+    depth, a shared multiprocessing.Value, if given counts the jobs queued or in progress across every renderer using it"""
+
+    def __init__(self, workers=2, queue_size=8, quality=75, optimize=False, placement='reflink', output_size=None, depth=None):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.save_options = {'quality': quality, 'optimize': optimize}
+        self.placement = placement
+        self.output_size = output_size
+        self.depth = depth
+        self.placed = 0
+        self.placed_bytes = 0
+        self.encoded_bytes = 0
+        self.made_dirs = set()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.stall_seconds = 0.0
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def make_dirs(self, folders):
+        """Create output folders up front, so saves don't have to"""
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+            self.made_dirs.add(folder)
+
+    def submit(self, image_out, detections, out_path, draw=True, source=None):
+        start = time.monotonic()
+        if self.depth is not None:
+            with self.depth.get_lock():
+                self.depth.value += 1
+        saving = Saving()
+        self.jobs.put((image_out, detections, out_path, draw, source, saving))
+        stalled = time.monotonic() - start
+        profiling.record('render_wait', stalled)
+        with self.lock:
+            self.stall_seconds = self.stall_seconds + stalled
+            self.submitted = self.submitted + 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+        return saving
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is _STOP:
+                return
+            image_out, detections, out_path, draw, source, saving = job
+            try:
+                self.save(image_out, detections, out_path, draw, source)
+                saving.saved = True
+            except Exception as e:
+                logger.warning(e)
+                with self.lock:
+                    self.failed = self.failed + 1
+            if self.depth is not None:
+                with self.depth.get_lock():
+                    self.depth.value -= 1
+            # Don't keep the image until the next job comes
+            job = image_out = None
+            saving.finished.set()
+
+    def save(self, image_out, detections, out_path, draw, source):
+        """Draw (if asked) and save one job's image, or place its source file as is"""
+        folder = os.path.dirname(out_path)
+        if folder not in self.made_dirs:
+            os.makedirs(folder, exist_ok=True)
+            with self.lock:
+                self.made_dirs.add(folder)
+        draw = draw and len(detections) != 0
+        if image_out is None and not draw and self.output_size is None:
+            with profiling.stage('place'):
+                place_file(source, out_path, self.placement)
+            with self.lock:
+                self.placed = self.placed + 1
+                self.placed_bytes = self.placed_bytes + os.path.getsize(out_path)
+            return
+        if image_out is None:
+            # Only annotated or resized copies need the image decoded
+            with profiling.stage('output_decode'):
+                image_out = Image.open(source)
+                if self.output_size is not None:
+                    w, h = image_out.size
+                    image_out = image_out.resize([int(self.output_size),int(int(self.output_size)/w*h)])
+        if draw:
+            with profiling.stage('draw'):
+                draw_detections(image_out, detections)
+        with profiling.stage('save'):
+            image_out.save(out_path, **self.save_options)
+        with self.lock:
+            self.encoded_bytes = self.encoded_bytes + os.path.getsize(out_path)
+
+    def stats(self):
+        return {'images': self.submitted, 'failed': self.failed, 'placed': self.placed,
+                'placed_bytes': self.placed_bytes, 'encoded_bytes': self.encoded_bytes, 'max_queue_depth': self.max_depth,
+                'queue_size': self.jobs.maxsize, 'stall_seconds': round(self.stall_seconds, 3)}
+
+    def close(self):
+        """Wait for every queued image to be saved"""
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.jobs.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        logger.info(f'Renderer {os.getpid()}: {self.stats()}')
@@ -8,7 +8,7 @@ from pkg_resources import DistributionNotFound, VersionConflict
 
 # dependencies can be any iterable with strings,
 # e.g. file line-by-line iterator
-dependencies = ['docker', 'GPUtil', 'numpy', 'pandas', 'Pillow', 'requests', 'tqdm', 'inquirer', 'pypiwin32']
+dependencies = ['docker', 'GPUtil', 'numpy', 'pandas', 'Pillow', 'requests', 'tqdm', 'inquirer', 'psutil', 'pypiwin32']
 
 # here, if a dependency is not met, a DistributionNotFound or VersionConflict
 # exception is thrown.
@@ -0,0 +1,90 @@
+## Record of which input files a run has already processed, kept in the output folder
+import json
+import os
+import sqlite3
+
+INDEX_FILE = 'resume.db'
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class ResumeIndex:
+    """Processed input files keyed by path, with the size and mtime they had at the time, plus the files that
+    failed (to retry) and a checkpoint of the run's state (counters, how far the detections file and the scan got).
+    Loaded into memory once so lookups do not touch the disk. New entries and the state are saved together
+    in one transaction on flush(), which the caller does once the files' detections are safely written,
+    so after a crash the index and the checkpoint always describe the same moment"""
+
+    def __init__(self, output):
+        self.connection = sqlite3.connect(os.path.join(output, INDEX_FILE))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS processed (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS failed (path TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, value TEXT)')
+        self.entries = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute('SELECT path, size, mtime_ns FROM processed')}
+        self.failed = {path for (path,) in self.connection.execute('SELECT path FROM failed')}
+        row = self.connection.execute("SELECT value FROM checkpoint WHERE key = 'state'").fetchone()
+        self.state = json.loads(row[0]) if row is not None else {}
+        self.unsaved = []
+        self.unsaved_failed = []
+        self.retried = []
+        self.forgotten = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_done(self, path, force=False):
+        """True if path was processed before. With force, a file whose size or mtime has changed since counts as not done"""
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        if not force:
+            return True
+        try:
+            return entry == file_key(path)
+        except OSError:
+            return False
+
+    def changed(self):
+        """Processed files that are still there but whose size or mtime has changed since"""
+        return {path for path in self.entries if not self.is_done(path, True) and os.path.exists(path)}
+
+    def forget(self, paths):
+        """Mark paths as not processed, e.g. once their rows are dropped to process them again"""
+        for path in paths:
+            if self.entries.pop(path, None) is not None:
+                self.forgotten.append((path,))
+
+    def add(self, path):
+        key = file_key(path)
+        self.entries[path] = key
+        self.unsaved.append((path,) + key)
+        if path in self.failed:
+            self.failed.discard(path)
+            self.retried.append((path,))
+
+    def add_failed(self, path):
+        if path not in self.failed:
+            self.failed.add(path)
+            self.unsaved_failed.append((path,))
+
+    def flush(self, state=None):
+        """Save new entries, and state if given, in one transaction"""
+        with self.connection:
+            self.connection.executemany('DELETE FROM processed WHERE path = ?', self.forgotten)
+            self.connection.executemany('INSERT OR REPLACE INTO processed VALUES (?, ?, ?)', self.unsaved)
+            self.connection.executemany('INSERT OR IGNORE INTO failed VALUES (?)', self.unsaved_failed)
+            self.connection.executemany('DELETE FROM failed WHERE path = ?', self.retried)
+            if state is not None:
+                self.connection.execute("INSERT OR REPLACE INTO checkpoint VALUES ('state', ?)", (json.dumps(state),))
+                self.state = state
+        self.unsaved = []
+        self.unsaved_failed = []
+        self.retried = []
+        self.forgotten = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
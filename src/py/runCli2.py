@@ -11,6 +11,7 @@ import requests
 import tqdm
 import time
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import multiprocessing
 from contextlib import closing
 import glob
@@ -20,8 +21,27 @@ import inquirer
 import platform
 import logging
 import utils
+import inference
+import async_engine
+import resume
+import scan
+import imaging
+import postprocessing
+import nms
+import sinks
+import render
+import shm_ring
+import containers
+import workqueue
+import profiling
+import metrics
+import concurrency
+import memory
+import signal
 import csv
 import io
+import itertools
+import collections
 
 #reads user input data from json file written by afterorg.tsx
 directory = os.path.dirname(os.path.realpath(__file__))
@@ -51,121 +71,368 @@ logger.debug('This is just debug message')
 super_logger = setup_logger('second_logger',  os.getcwd()+"\src\py\progress.csv", logging.INFO)
 super_logger.info('Started processing images')
 
-def process(filename):
-    detections = []
-    # Convert Confidence Threshold to 0-1 from 0-100
-    confidence_threshold = float(os.environ.get('THRESHOLD'))/100
-    output = os.environ.get('OUTPUT')
-    input  = os.environ.get('INPUT')
-    output_size = os.environ.get('OUTPUT_SIZE')
-    input_size  = int(os.environ.get('INPUT_SIZE'))
-    output_style  = os.environ.get('OUTPUT_STYLE')
-    model  = os.environ.get('MODEL')
-    class_names  = os.environ.get('CLASS_NAMES').split(',')
-    # Make pictures with bounded boxes if requested
-
-    if len(glob.glob(f"{output}/**/{os.path.basename(filename)}")) != 0:
-        logger.debug('Processed')
-        return 'Processed'
+# Run settings and the image writer, set up once per worker process by init_worker
+settings = {}
+renderer = None
+# Shared memory engine: the ring of decoded images and the decode worker pool
+ring = None
+decoders = None
+
+def init_worker(run_settings):
+    global renderer
+    settings.update(run_settings)
+    memory.release_freed_images()
+    inference.init_replicas(settings['replica_ports'], settings['replica_load'])
+    inference.init_session()
+    inference.init_limit(settings['request_limit'])
+    renderer = render.Renderer(settings['render_workers'], settings['render_queue'], settings['jpeg_quality'], settings['jpeg_optimize'], settings['placement'], settings['output_size'], settings['render_depth'])
+    renderer.make_dirs(output_dirs(settings))
+    # Pool workers that exit cleanly finish saving their queued images first
+    multiprocessing.util.Finalize(None, renderer.close, exitpriority=10)
+    init_profiling(settings)
+
+
+## Stage timers (and cProfile if asked) for this process. Worker processes leave their timings
+## in the profile folder as they exit, for the main process to add to profile.json
+def init_profiling(run_settings):
+    profiling.configure(run_settings['stage_timers'], run_settings['cprofile'])
+    if run_settings['stage_metrics'] is not None:
+        profiling.observe(metrics.observer(run_settings['stage_metrics']))
+    if multiprocessing.parent_process() is not None:
+        multiprocessing.util.Finalize(None, profiling.dump, args=(run_settings['profile_dir'],), exitpriority=5)
+
+
+## Output folders known before any image is processed
+def output_dirs(run_settings):
+    if run_settings['output_style'] == 'class':
+        return [os.path.join(run_settings['output'], name) for name in run_settings['class_names'] + [postprocessing.EMPTY_CLASS]]
+    if run_settings['output_style'] == 'none':
+        return []
+    return [run_settings['output']]
+
+
+## Returns the image's detections, and the Saving for its output copy (None if there isn't one)
+def postprocess(filename, image_out, predictions):
+    output = settings['output']
+    input  = settings['input']
+    output_style  = settings['output_style']
+    with profiling.stage('postprocess'):
+        detections = postprocessing.decode_predictions(predictions, settings['input_size'], settings['class_names'],
+                                                       settings['threshold'], settings['class_thresholds'], settings['top_k'])
+        # Drop overlapping duplicates of the same object
+        detections = nms.suppress(detections, settings['nms'], settings['iou_thresh'], settings['max_predictions'])
+
+    # Images are sorted by their most confident detection
+    class_name = detections['class_name'][0] if len(detections) != 0 else postprocessing.EMPTY_CLASS
+
+    if output_style == 'flat':
+        out_path = r'{}/{}'.format(output,os.path.basename(filename))
+    elif output_style == 'hierachy' or output_style == 'timelapse':
+        out_path = r'{}/{}'.format(output,filename.replace(input,''))
+    elif output_style == 'class':
+        out_path = r'{}/{}/{}'.format(output,class_name,os.path.basename(filename))
+    elif output_style == 'none':
+        pass
     else:
+        logger.error('Error: Output Style is incorrect')
+        print('Error: Output Style is incorrect')
+    # Hand drawing and saving to the renderer so this worker can move on to the next image
+    if output_style == 'none':
+        return detections, None
+    return detections, renderer.submit(image_out, detections, out_path, draw=output_style != 'timelapse', source=filename)
+
+
+## Whether the output copy is decoded up front. Full size copies are placed straight from the
+## input file instead, and only decoded later if they need boxes drawn on them
+def keep_output(run_settings):
+    if run_settings['output_style'] == 'none':
+        return False
+    return run_settings['output_size'] is not None or run_settings['placement'] == 'encode'
+
+
+## Decodes and resizes a batch of images
+def prepare_batch(filenames):
+    output_size = settings['output_size']
+    input_size  = settings['input_size']
+
+    results = {}
+    pending = []
+    for filename in filenames:
         try:
             logger.debug("processing images")
-            img = Image.open(filename)
-            image = img.resize([input_size,input_size])
-            if output_size != 'None':
-                w, h = img.size
-                image_out = img.resize([int(output_size),int(int(output_size)/w*h)])
-            else:
-                image_out = img
-            width_out, height_out = image_out.size
-
-            # Normalize and batchify the image
-            im = np.expand_dims(np.array(image), 0).tolist()
-            url = 'http://localhost:8501/v1/models/{}:predict'.format(model)
-            k = 0
-            while True:
-                if k == 10:
-                    data = json.dumps({"signature_name": "serving_default", "instances": im})
-                else:
-                    try:
-                        data = json.dumps({"signature_name": "serving_default", "instances": im})
-                        break
-                    except Exception as e:
-                        time.sleep(0.2)
-                        k = k + 1
-
-            headers = {"content-type": "application/json"}
-            json_response = requests.post(url, data=data, headers=headers,timeout=30)
-            predictions = json.loads(json_response.text)['predictions'][0]
-
-            # Check there are any predictions
-            if predictions['output_1'][0] > confidence_threshold:
-                ## Continue to loop through predictions until the confidence is less than specified confidence threshold
-                x = 0
-                while True:
-                    if predictions['output_1'][x]>confidence_threshold and x < len(predictions['output_1']):
-                        bbox = [i / input_size for i in predictions['output_0'][x]]
-                        class_id = predictions['output_2'][x]
-                        confidence = predictions['output_1'][x]
-                        class_name = class_names[int(class_id)-1]
-
-                        # Make pictures with bounded boxes if requested
-                        # Draw bounding_box
-
-                        if output_style != 'timelapse':
-                            draw = ImageDraw.Draw(image_out)
-                            draw.rectangle([(bbox[1]*width_out,bbox[0]*height_out),(bbox[3]*width_out,bbox[2]*height_out)],outline='red',width=3)
-
-                            # Draw label and score
-                            result_text = str(class_name) + ' (' + str(confidence) + ')'
-                            draw.text((bbox[1] + 10, bbox[0] + 10),result_text,fill='red')
-                        entry = [os.path.basename(filename),class_name,class_id,confidence,filename,bbox]
-                        detections.append(entry)
-
-                        x = x + 1
-                    else:
-                        break
-            else:
-                class_name = 'blank'
-                detections.append([os.path.basename(filename),class_name,0,0,filename,''])
-
-
-            if output_style == 'flat':
-                out_path = r'{}/{}'.format(output,os.path.basename(filename))
-            elif output_style == 'hierachy' or output_style == 'timelapse':
-                out_path = r'{}/{}'.format(output,filename.replace(input,''))
-            elif output_style == 'class':
-                out_path = r'{}/{}/{}'.format(output,class_name,os.path.basename(filename))
-            elif output_style == 'none':
-                pass
-            else:
-                logger.error('Error: Output Style is incorrect')
-                print('Error: Output Style is incorrect')
-            #save to file
-            if output_style != 'none':
-                try:
-                    image_out.save(out_path)
-                except Exception as e:
-                    os.makedirs(out_path.replace(os.path.basename(filename),''))
-                    image_out.save(out_path)
+            with profiling.stage('decode'):
+                image, image_out = imaging.preprocess(filename, input_size, output_size, keep_output(settings))
+            pending.append((filename, image, image_out))
+        except Exception as e:
+            logger.warning(e)
+            results[filename] = None
+    return results, pending
+
+
+## Draws and saves the images of a batch once the model has answered.
+## predictions holds one entry per pending image, or None where the request failed.
+## Each image's result is its structured array of detections, or None if it failed.
+## Returns only once the batch's output copies are written, so a file is never recorded as done without its copy,
+## and the batches under way (see memory.Dispatcher) include the ones still being drawn and saved
+def finish_batch(filenames, results, pending, predictions):
+    savings = []
+    # Map the predictions back onto the files they came from
+    for (filename, _, image_out), prediction in zip(pending, predictions):
+        if prediction is None:
+            results[filename] = None
+            continue
+        try:
+            results[filename], saving = postprocess(filename, image_out, prediction)
+            if saving is not None:
+                savings.append((filename, saving))
+        except Exception as e:
+            logger.warning(e)
+            results[filename] = None
+    # The copies of other images are drawn and saved meanwhile. An image whose copy wasn't saved is retried next run
+    for filename, saving in savings:
+        if not saving.wait():
+            results[filename] = None
+    return [(filename, results[filename]) for filename in filenames]
+
+
+## Runs a batch of images through the model with a single request (this is a threaded function)
+def process_batch(filenames):
+    results, pending = prepare_batch(filenames)
+    predictions = []
+    if len(pending) != 0:
+        try:
+            predictions = inference.predict([image for _, image, _ in pending], settings['model'], settings['transport'])
         except Exception as e:
             logger.warning(e)
-            detections.append([os.path.basename(filename),99,0,filename,''])
-        return detections
+            predictions = [None] * len(pending)
+    return finish_batch(filenames, results, pending, predictions)
 
 
+def process(filename):
+    filename, detections = process_batch([filename])[0]
+    return postprocessing.rows(filename, detections)
+
+
+## Shared memory engine: images are decoded in worker processes straight into a shared ring of slots,
+## and requests, drawing and saving happen in this process, so decoded pixels never go through a pipe
+def ring_shape(run_settings):
+    return (run_settings['input_size'], run_settings['input_size'], 3)
+
+
+def init_decoder(run_settings, ring_name, ring_slots):
+    global ring
+    # Ctrl+C (or SIGINT from the Electron host) is handled by the main process, which stops the decoders
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    settings.update(run_settings)
+    memory.release_freed_images()
+    ring = shm_ring.SlotRing(ring_slots, ring_shape(run_settings), ring_name)
+    init_profiling(settings)
 
-def main(opt,container=None):
 
-    os.environ['THRESHOLD'] = str(opt.thresh)
-    os.environ['OUTPUT'] = opt.output
-    os.environ['INPUT'] = opt.input
-    os.environ['OUTPUT_SIZE'] = str(opt.output_size)
-    os.environ['INPUT_SIZE'] = str(opt.input_size)
-    os.environ['OUTPUT_STYLE'] = str(opt.output_style)
-    os.environ['MODEL'] = opt.model
-    os.environ['CLASS_NAMES'] = utils.get_class_names(container,opt.model)
+## Decodes a batch of images into the slots it was given (runs in a decode worker)
+def decode_to_slots(filenames, slots):
+    decoded = []
+    for filename, slot in zip(filenames, slots):
+        try:
+            logger.debug("processing images")
+            with profiling.stage('decode'):
+                image, _ = imaging.preprocess(filename, settings['input_size'], None, keep_output=False)
+                ring.write(slot, image.convert('RGB'))
+            decoded.append(True)
+        except Exception as e:
+            logger.warning(e)
+            decoded.append(False)
+    return decoded
 
+
+## Runs a batch through the decoders and the model, holding its slots until the request is sent (this is a threaded function)
+def shm_batch(filenames):
+    slots = ring.acquire(len(filenames))
+    try:
+        decoded = decoders.apply(decode_to_slots, (filenames, slots))
+        results = {filename: None for filename, ok in zip(filenames, decoded) if not ok}
+        pending = [(filename, ring.view(slot), None) for filename, slot, ok in zip(filenames, slots, decoded) if ok]
+        predictions = []
+        if len(pending) != 0:
+            try:
+                predictions = inference.predict([image for _, image, _ in pending], settings['model'], settings['transport'])
+            except Exception as e:
+                logger.warning(e)
+                predictions = [None] * len(pending)
+        # Don't keep views of slots that are about to be reused
+        pending = [(filename, None, None) for filename, _, _ in pending]
+    finally:
+        ring.release(slots)
+    return finish_batch(filenames, results, pending, predictions)
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_shm(opt,run_settings,batches,num_workers):
+    global ring, decoders
+    init_worker(run_settings)
+    inference.init_session(in_flight_ceiling(opt))
+    ring = shm_ring.SlotRing(ring_slots(opt,ring_shape(run_settings)),ring_shape(run_settings))
+    # SIGTERM unwinds like Ctrl+C, so the shared memory is unlinked however the host stops us
+    previous = signal.signal(signal.SIGTERM,raise_interrupt)
+    try:
+        with multiprocessing.Pool(processes=num_workers,initializer=init_decoder,initargs=(run_settings,ring.name,ring.slots)) as decoders, \
+             ThreadPool(in_flight_ceiling(opt)) as clients:
+            yield from clients.imap_unordered(shm_batch,batches)
+            # Let the decoders exit on their own so they leave their timings behind
+            decoders.close()
+            decoders.join()
+        renderer.close()
+    finally:
+        signal.signal(signal.SIGTERM,previous)
+        ring.close()
+
+
+## What decides which files a scan finds. A checkpoint's scan position is only reused if this hasn't changed
+def scan_signature(opt):
+    return json.dumps([opt.input,opt.extensions,opt.include,opt.exclude])
+
+
+## Yields image paths as the input folder is scanned, growing the progress bar total as they are found.
+## Images that failed last time come first. The scan then picks up after the last checkpoint's position,
+## so a resumed run doesn't list the folders it already got through. Scanned paths are appended to order.
+## A run that got to the end of the scan leaves no position, so the next run looks for new images everywhere
+def find_images(opt,index,pbar,scan_counts,order):
+    found = 0
+    retry = sorted(path for path in index.failed if os.path.exists(path))
+    retried = set(retry)
+    start_after = None
+    if not opt.force and index.state.get('scan',{}).get('signature') == scan_signature(opt):
+        start_after = index.state['scan']['after']
+    scanned = (image for image in scan.scan_images(opt.input,opt.extensions,opt.include,opt.exclude,start_after) if image not in retried)
+    for image in itertools.chain(retry,scanned):
+        if index.is_done(image,opt.force):
+            scan_counts['skipped'] = scan_counts['skipped'] + 1
+            continue
+        found = found + 1
+        pbar.total = found
+        pbar.refresh()
+        if image not in retried:
+            order.append(image)
+        yield image
+        if found == opt.max_images:
+            return
+    scan_counts['complete'] = True
+
+
+## Yields the results of each batch from the chosen engine. Batches go out through the dispatcher,
+## so only so many are ever under way (and fewer while over the memory budget), however big the folder
+def run_batches(opt,run_settings,images,num_workers,dispatcher):
+    batches = dispatcher.feed(inference.batched(images,opt.batch_size,opt.max_wait))
+    try:
+        for batch in engine_batches(opt,run_settings,batches,num_workers):
+            dispatcher.done()
+            yield batch
+    finally:
+        # Don't leave an engine's feeding thread waiting for batches that will never be asked for
+        dispatcher.close()
+
+
+## Batches under way at once: enough to keep every worker busy with one more waiting. The async and shm engines
+## follow the request limit as it is tuned, so batches aren't decoded far ahead of what the model is taking
+def max_pending(opt,num_workers,request_limit):
+    if opt.engine in ('async','shm'):
+        return lambda: 2 * request_limit.limit()
+    return 2 * num_workers
+
+
+def engine_batches(opt,run_settings,batches,num_workers):
+    if opt.engine == 'async':
+        init_worker(run_settings)
+        yield from async_engine.imap(batches,prepare_batch,finish_batch,opt.model,opt.transport,in_flight_ceiling(opt),opt.decode_workers)
+        renderer.close()
+    elif opt.engine == 'shm':
+        yield from run_shm(opt,run_settings,batches,num_workers)
+    else:
+        with closing(multiprocessing.Pool(processes=num_workers,initializer=init_worker,initargs=(run_settings,))) as pool:
+            yield from pool.imap_unordered(process_batch,batches)
+            # Let the workers exit on their own so they finish saving images
+            pool.close()
+            pool.join()
+
+
+## Worker processes: decoding in the shm engine, everything but writing the detections in the pool engine
+def worker_count(opt):
+    return opt.workers or max(multiprocessing.cpu_count() - 2, 1)
+
+
+## Most requests the async and shm engines can have in flight: --max_in_flight if given, otherwise the fixed
+## --concurrency, or for adaptive enough room to climb to wherever the model's throughput peaks
+ADAPTIVE_IN_FLIGHT = 64
+
+def in_flight_ceiling(opt):
+    if opt.max_in_flight is not None:
+        return opt.max_in_flight
+    if opt.concurrency != 'adaptive':
+        return int(opt.concurrency)
+    return ADAPTIVE_IN_FLIGHT * opt.replicas
+
+
+## Slots in the shm engine's ring: a batch for every request that can be in flight, unless that would take
+## more than SHM_RING_BYTES of shared memory (large input sizes), and never less than one batch
+SHM_RING_BYTES = 512 * 2**20
+
+def ring_slots(opt,shape):
+    if opt.shm_slots is not None:
+        return max(opt.shm_slots,opt.batch_size)
+    slot_bytes = int(np.prod(shape))
+    return max(min(in_flight_ceiling(opt) * opt.batch_size, SHM_RING_BYTES // slot_bytes),opt.batch_size)
+
+
+## The limit on requests in flight shared by every worker. It can't go above what the engine can have in flight:
+## one request per worker process in the pool engine, in_flight_ceiling in the others
+def make_request_limit(opt):
+    maximum = in_flight_ceiling(opt) if opt.engine in ('async','shm') else worker_count(opt)
+    if opt.concurrency == 'adaptive':
+        return concurrency.AdaptiveLimit(2,maximum)
+    return concurrency.AdaptiveLimit(int(opt.concurrency),maximum,adaptive=False)
+
+
+def make_run_settings(opt,container=None):
+    return {
+        # Convert Confidence Threshold to 0-1 from 0-100
+        'threshold': float(opt.thresh)/100,
+        'output': opt.output,
+        'input': opt.input,
+        'output_size': opt.output_size,
+        'input_size': opt.input_size,
+        'output_style': str(opt.output_style),
+        'model': opt.model,
+        'transport': opt.transport,
+        'class_names': (opt.class_names or utils.get_class_names(container,opt.model)).split(','),
+        'class_thresholds': postprocessing.parse_class_thresholds(opt.class_thresh),
+        'top_k': opt.top_k,
+        'nms': opt.nms,
+        'iou_thresh': opt.iou_thresh,
+        'max_predictions': opt.max_predictions,
+        'render_workers': opt.render_workers,
+        'render_queue': opt.render_queue,
+        'jpeg_quality': opt.jpeg_quality,
+        'jpeg_optimize': opt.jpeg_optimize,
+        'placement': opt.placement,
+        'replica_ports': inference.replica_ports(opt.replicas),
+        # Requests outstanding at each replica, shared by all the workers
+        'replica_load': multiprocessing.Array('i', opt.replicas),
+        'request_limit': make_request_limit(opt),
+        # The metrics endpoint needs the stage timers even if profile.json isn't wanted
+        'stage_timers': not opt.no_timers or opt.metrics_port is not None,
+        'cprofile': opt.cprofile,
+        'profile_dir': os.path.join(opt.output, profiling.PROFILE_DIR),
+        # Shared by all the workers for the metrics endpoint
+        'stage_metrics': metrics.stage_histograms() if opt.metrics_port is not None else None,
+        'render_depth': multiprocessing.Value('i', 0) if opt.metrics_port is not None else None,
+    }
+
+
+## Waits for the model to load and warms it up. Returns the seconds that took and the warm-up request latencies
+def start_model(opt,run_settings):
     # Check resources available on current machine
     try:
         GPU_num = len(GPUtil.getAvailable())
@@ -177,76 +444,339 @@ def main(opt,container=None):
         logger.warning('Error')
         GPU_num = 'Unknown'
     logger.warning(f"CPUs Available: {os.cpu_count()}, GPUs Available: {GPU_num}")
-    time.sleep(3)
 
-    ## Make list of files
-    images = []
+    ## Wait for the container to load the model and warm it up before any images are sent
+    startup_start = time.monotonic()
+    try:
+        for port in run_settings['replica_ports']:
+            inference.wait_until_ready(opt.model, opt.ready_timeout, port=port)
+        ready_seconds = time.monotonic() - startup_start
+    except TimeoutError as e:
+        logger.error(e)
+        exit(str(e))
+    inference.init_replicas(run_settings['replica_ports'], run_settings['replica_load'])
+    inference.init_session()
+    try:
+        # Enough warm-up batches for every replica to get its share
+        warmup_ms = inference.warm_up(opt.model, opt.input_size, opt.transport, opt.batch_size, opt.warmup_batches * opt.replicas)
+    except Exception as e:
+        logger.warning(f'Warm-up failed: {e}')
+        warmup_ms = []
+    startup_seconds = time.monotonic() - startup_start
+    logger.warning(f"Model ready after {ready_seconds:.1f}s, warm-up requests took {', '.join(f'{ms:.0f}' for ms in warmup_ms)} ms")
+    return startup_seconds, warmup_ms
+
 
-    for path, subdirs, files in os.walk(opt.input):
-        for file in files:
-            if file.endswith(".jpg") or file.endswith(".jpeg") or file.endswith(".png") or file.endswith(".JPG") or file.endswith(".JPEG") or file.endswith(".PNG"):
-                images.append(os.path.join(path, file))
-    if opt.max_images != None:
-        images = images[:opt.max_images]
+def main(opt,container=None):
 
-    if len(images) == 0:
+    run_settings = make_run_settings(opt,container)
+    startup_seconds, warmup_ms = start_model(opt,run_settings)
+    # Warm-up requests aren't part of the run
+    profiling.reset(run_settings['profile_dir'])
+    init_profiling(run_settings)
+
+    ## Stream the files to process, skipping ones an earlier run into this output folder already got through
+    index = resume.ResumeIndex(opt.output)
+    pbar = tqdm.tqdm(total=0)
+    scan_counts = {'skipped': 0}
+    # Scanned paths in the order they were handed out, for working out how far the scan is safely done
+    order = collections.deque()
+    images = find_images(opt,index,pbar,scan_counts,order)
+    first = next(images,None)
+    if first is None:
+        # Still cut the detections back to the last checkpoint, in case the run that got through them crashed
+        sink_state = index.state.get('sink',{})
+        if sink_state.get('format') == opt.detections_format:
+            sinks.open_sink(opt.output,opt.detections_format,offset=sink_state['offset']).close()
+        index.close()
+        if scan_counts['skipped'] != 0 or len(index) != 0:
+            exit('All images already processed')
         exit('No images found')
+    images = itertools.chain([first],images)
 
+    num_workers = worker_count(opt)
+    if opt.engine == 'async':
+        logger.warning(f'Processing with up to {in_flight_ceiling(opt)} requests in flight and {opt.decode_workers} decode threads')
+    elif opt.engine == 'shm':
+        logger.warning(f'Processing with up to {in_flight_ceiling(opt)} requests in flight and {num_workers} decode processes')
+    else:
+        logger.warning(f'Processing on {num_workers} parallel threads. (It may take a few seconds to start!)')
+
+    ## Carry on from the last checkpoint: its counters, and the detections file cut back to what it had written
+    counts = {'images': 0, 'objects': 0, 'empty': 0, 'detections': 0, 'failed': 0}
+    counts.update(index.state.get('counts',{}))
+    sink_state = index.state.get('sink',{})
+    offset = sink_state.get('offset') if sink_state.get('format') == opt.detections_format else None
+    if len(index.state) != 0:
+        logger.warning(f"Resuming after {counts['images']} images")
+    budget = memory.MemoryBudget(memory.parse_size(opt.max_memory)) if opt.max_memory is not None else None
+    dispatcher = memory.Dispatcher(max_pending(opt,num_workers,run_settings['request_limit']),budget)
+    watermark = index.state.get('scan',{}).get('after')
+    done = set()
+    image_count = 0
+    checkpoint_seconds = 0.0
+    run_start = time.monotonic()
+    sink = sinks.open_sink(opt.output,opt.detections_format,opt.flush_rows,opt.flush_seconds,offset)
+    redone = redone_paths(opt,index)
+    if len(redone) != 0:
+        sink.close()
+        drop_redone(opt,counts,redone)
+        index.forget(redone)
+        sink = sinks.open_sink(opt.output,opt.detections_format,opt.flush_rows,opt.flush_seconds)
+        index.flush(checkpoint_state(opt,sink.checkpoint(),counts,watermark))
+    server = None
+    if opt.metrics_port is not None:
+        server = metrics.MetricsServer(lambda: metrics_text(run_settings,counts,pbar.total - image_count,sink),opt.metrics_port,opt.metrics_host)
+        logger.warning(f'Serving metrics at {server.url}')
+    try:
+        # write out all rows from incoming lists of rows
+        for filename, detections in (result for batch in run_batches(opt,run_settings,images,num_workers,dispatcher) for result in batch):
+            if detections is not None and len(detections) != 0:
+                counts['objects'] = counts['objects'] + 1
+            else:
+                counts['empty'] = counts['empty'] + 1
+            counts['images'] = counts['images'] + 1
+            if detections is not None:
+                counts['detections'] = counts['detections'] + len(detections)
+            else:
+                counts['failed'] = counts['failed'] + 1
+            pbar_text = f"Found {counts['objects']} objects in {counts['images']} images. {counts['empty']} empty images"
+            with profiling.stage('write'):
+                sink.write(postprocessing.rows(filename,detections))
+            # Failed images are left out of the index so the next run retries them
+            if detections is not None:
+                index.add(filename)
+            else:
+                index.add_failed(filename)
+            # The scan is safely done up to the last path whose earlier paths have all come back
+            done.add(filename)
+            while len(order) != 0 and order[0] in done:
+                done.discard(order[0])
+                watermark = os.path.relpath(order.popleft(),opt.input).replace(os.sep,'/')
+            # Only record files in the index once their rows are on disk
+            if (image_count + 1) % opt.checkpoint_every == 0:
+                start = time.monotonic()
+                index.flush(checkpoint_state(opt,sink.checkpoint(),counts,watermark))
+                write_results(counts,startup_seconds,warmup_ms,run_settings['request_limit'].stats())
+                checkpoint_seconds = checkpoint_seconds + time.monotonic() - start
+                profiling.record('checkpoint',time.monotonic() - start)
+
+            pbar.set_description(pbar_text, refresh=True)
+            pbar.update(1)
+            image_count = image_count + 1
+            super_logger.info(image_count)
+        if scan_counts.get('complete'):
+            watermark = None
+    finally:
+        # Also reached on Ctrl+C, so an interrupted run resumes from exactly here
+        index.flush(checkpoint_state(opt,sink.checkpoint(),counts,watermark))
+        sink.close()
+        index.close()
+        if server is not None:
+            server.close()
+        if budget is not None:
+            budget.close()
+    if scan_counts['skipped'] != 0:
+        logger.warning(f"{scan_counts['skipped']} images already processed")
+    ## The concurrency the run settled on goes in the summary too, since profile.json is skipped with --no_timers
+    limit = run_settings['request_limit'].stats()
+    if limit['adaptive']:
+        logger.warning(f"Requests in flight settled at {limit['limit']} (between {limit['lowest']} and {limit['highest']}, at most {limit['maximum']})")
+    if budget is not None:
+        logger.warning(f"Peak memory {budget.peak / 2**20:.0f} MB of {budget.limit / 2**20:.0f} MB, "
+                       f"held back new batches {budget.pauses} times, {budget.exceeded_seconds:.1f}s near the limit")
+    logger.warning(f'Checkpoints took {checkpoint_seconds:.2f}s, {checkpoint_seconds / max(time.monotonic() - run_start, 1e-9) * 100:.2f}% of the run')
+    write_results(counts,startup_seconds,warmup_ms,limit)
+    run_seconds = time.monotonic() - run_start
+    if run_settings['stage_timers'] or opt.cprofile:
+        profiling.write_profile(os.path.join(opt.output,profiling.PROFILE_FILE),run_settings['profile_dir'],
+                                profile_info(opt,image_count,run_seconds,startup_seconds,limit,
+                                             budget.stats() if budget is not None else None))
+    pbar.close()
 
+    if opt.output_style == 'timelapse':
+        utils.generate_timelapse_file(opt)
 
 
-
-    num_workers = multiprocessing.cpu_count() - 2
-    logger.warning(f'Processing on {num_workers} parallel threads. (It may take a few seconds to start!)')
-    pbar = tqdm.tqdm(total=len(images))
-    image_count = 0
-    empty_count = 0
-    detection_count_1 = 0
-    with open(f'{opt.output}/detections.csv', 'a',newline='') as file:
-        fieldnames = [['File','Class Name','ClassID','Confidence','Path','Bounded Box']]
-        writer = csv.writer(file)
-        writer.writerows(fieldnames)
-        detection_count = 0
-        with closing(multiprocessing.Pool(processes=num_workers)) as pool:
-            detections = pool.imap_unordered(process,images)
-            # open file and write out all rows from incoming lists of rows
-            for detection in detections:
-                if detection=='Processed':
-                    pbar_text = 'Already Processed'
-                elif detection[0][2] != 0:
-                    detection_count = detection_count + 1
-                    detection_count_1 = detection_count_1+1
-                else:
-                    empty_count = empty_count + 1
-                pbar_text = f'Found {detection_count} objects in {image_count} images. {empty_count} empty images'
-                if detection!='Processed':
-                    writer.writerows(detection)
-
-                pbar.set_description(pbar_text, refresh=True)
-                pbar.update(1)
-                image_count = image_count + 1
-                super_logger.info(image_count)
-#writes results to file, Results.json
+## Files an earlier run wrote rows for that this one processes again: the failures it retries,
+## and with --force the processed files that have changed since
+def redone_paths(opt,index):
+    redone = {path for path in index.failed if os.path.exists(path)}
+    if opt.force:
+        redone.update(index.changed())
+    return redone
+
+
+## Drops the earlier rows of files processed again and takes them back off the counts restored from the checkpoint,
+## so they end up with only their new rows and are counted once
+def drop_redone(opt,counts,paths):
+    removed = sinks.remove_paths(opt.output,paths,opt.detections_format)
+    for path, rows in removed.groupby('Path'):
+        names = set(rows['Class Name'].astype(str))
+        counts['images'] = max(counts['images'] - 1, 0)
+        if names <= {postprocessing.EMPTY_CLASS, str(postprocessing.ERROR_CLASS)}:
+            counts['empty'] = max(counts['empty'] - 1, 0)
+            if str(postprocessing.ERROR_CLASS) in names:
+                counts['failed'] = max(counts['failed'] - 1, 0)
+        else:
+            counts['objects'] = max(counts['objects'] - 1, 0)
+            counts['detections'] = max(counts['detections'] - len(rows), 0)
+    logger.warning(f'Processing {len(paths)} images again, dropped their {len(removed)} earlier rows')
+
+
+## What profile.json says about the run, besides the stage timings
+def profile_info(opt,image_count,run_seconds,startup_seconds,request_limit,memory=None):
+    return {'engine': opt.engine, 'transport': opt.transport, 'batch_size': opt.batch_size, 'replicas': opt.replicas,
+            'images': image_count, 'run_seconds': round(run_seconds,3), 'images_per_second': round(image_count / max(run_seconds,1e-9),2),
+            'startup_seconds': round(startup_seconds,3), 'requests_in_flight': request_limit, 'memory': memory}
+
+
+## The metrics endpoint's page: main's counters, what is queued or in flight, and the stage latencies
+def metrics_text(run_settings,counts,pending,sink):
+    families = [
+        ('images_processed_total', 'counter', 'Images processed, including those of earlier runs this one resumed', [({}, counts['images'])]),
+        ('images_with_detections_total', 'counter', 'Processed images with at least one detection', [({}, counts['objects'])]),
+        ('empty_images_total', 'counter', 'Processed images with no detections, or that failed', [({}, counts['empty'])]),
+        ('detections_total', 'counter', 'Detections written', [({}, counts['detections'])]),
+        ('image_errors_total', 'counter', 'Images that could not be read or whose request failed', [({}, counts['failed'])]),
+        ('requests_in_flight', 'gauge', 'Batch requests waiting on the model', [({}, run_settings['request_limit'].in_flight())]),
+        ('requests_in_flight_limit', 'gauge', 'Most batch requests allowed in flight at once', [({}, run_settings['request_limit'].limit())]),
+        ('replica_requests_in_flight', 'gauge', 'Batch requests waiting on each model replica, when there are several',
+         [({'replica': str(i)}, load) for i, load in enumerate(run_settings['replica_load'][:])]),
+        ('images_pending', 'gauge', 'Images found by the scan and not processed yet', [({}, pending)]),
+        ('render_queue_depth', 'gauge', 'Output images waiting to be drawn and saved', [({}, run_settings['render_depth'].value)]),
+        ('sink_buffered_rows', 'gauge', 'Detection rows waiting to be written out', [({}, len(sink.buffer))]),
+    ]
+    return metrics.exposition(families,run_settings['stage_metrics'])
+
+
+def checkpoint_state(opt,sink_offset,counts,watermark):
+    return {'sink': {'format': opt.detections_format, 'offset': sink_offset},
+            'counts': counts,
+            'scan': {'signature': scan_signature(opt), 'after': watermark}}
+
+
+## Writes results to file, Results.json. Replaced in one go, so a reader never sees half a file
+def write_results(counts,startup_seconds,warmup_ms,request_limit):
     dictionary = [{
-                "imagecount": f'{image_count}',
-                "objects": f'{detection_count_1}',
-                "emptyimages": f'{empty_count}',
+                "imagecount": f"{counts['images']}",
+                "objects": f"{counts['objects']}",
+                "emptyimages": f"{counts['empty']}",
+                "startupseconds": f'{startup_seconds:.2f}',
+                "firstrequestms": f'{warmup_ms[0]:.0f}' if len(warmup_ms) != 0 else '',
+                "requestlimit": f"{request_limit['limit']}",
+                "requestlimitlowest": f"{request_limit['lowest']}",
+                "requestlimithighest": f"{request_limit['highest']}",
     }]
 
             # Serializing json
     json_object = json.dumps(dictionary, indent=4)
 
-            # Writing to sample.json
-    with open(os.getcwd()+"\src\py\Results.json", "w") as outfile:
+    path = os.getcwd()+"\src\py\Results.json"
+    with open(path + '.tmp', "w") as outfile:
         outfile.write(json_object)
+    os.replace(path + '.tmp', path)
+
+
+## Distributed runs: a coordinator queues the input folder in a work queue on a shared folder, and workers on
+## any number of machines lease chunks of it and process them against their own model container.
+## Paths in the queue are relative to the input folder, with / separators, since every machine mounts it differently
+def run_coordinator(opt):
+    queue = workqueue.WorkQueue(opt.queue)
+    images = scan.scan_images(opt.input,opt.extensions,opt.include,opt.exclude)
+    added = queue.enqueue((os.path.relpath(image,opt.input).replace(os.sep,'/') for image in images),opt.chunk_size)
+    queue.set_meta('queued','1')
+    logger.warning(f'Queued {added} new images')
+
+    ## Wait for the workers, then merge what they found
+    progress = queue.progress()
+    pbar = tqdm.tqdm(total=sum(progress.values()))
+    while progress['pending'] != 0 or progress['leased'] != 0:
+        pbar.set_description(f"{progress['leased']} images being processed", refresh=True)
+        pbar.update(progress['done'] - pbar.n)
+        time.sleep(opt.poll_seconds)
+        progress = queue.progress()
+    pbar.update(progress['done'] - pbar.n)
     pbar.close()
+    merge_queue(opt,queue)
+    queue.close()
+
 
+## Rewrites the output folder's detections from everything in the queue, so merging again gives the same file
+def merge_queue(opt,queue):
+    rows = [row[:4] + (os.path.join(opt.input,*row[4].split('/')),) + row[5:] for row in queue.rows()]
+    sinks.replace_detections(opt.output,rows,opt.detections_format)
+    images = {}
+    for row in rows:
+        images[row[4]] = images.get(row[4],False) or row[2] != 0
+    dictionary = [{
+                "imagecount": f'{len(images)}',
+                "objects": f'{sum(images.values())}',
+                "emptyimages": f'{len(images) - sum(images.values())}',
+    }]
+    with open(os.getcwd()+"\src\py\Results.json", "w") as outfile:
+        outfile.write(json.dumps(dictionary, indent=4))
+    logger.warning(f'Merged {len(rows)} rows for {len(images)} images into {sinks.sink_path(opt.output,opt.detections_format)}')
     if opt.output_style == 'timelapse':
         utils.generate_timelapse_file(opt)
 
 
-## Set up the processing parameters and fill in anything not covered by CLI parameters with user input
-def run():
+def run_worker(opt,container=None):
+    queue = workqueue.WorkQueue(opt.queue)
+    owner = workqueue.worker_id()
+    run_settings = make_run_settings(opt,container)
+    # Several workers share the output folder, so each keeps its timings apart
+    run_settings['profile_dir'] = os.path.join(opt.output,profiling.PROFILE_DIR,owner.replace(':','-'))
+    startup_seconds, _ = start_model(opt,run_settings)
+    profiling.reset(run_settings['profile_dir'])
+    init_profiling(run_settings)
+    image_count = 0
+    run_start = time.monotonic()
+    num_workers = worker_count(opt)
+    with closing(multiprocessing.Pool(processes=num_workers,initializer=init_worker,initargs=(run_settings,))) as pool:
+        while True:
+            claimed = queue.claim(owner,opt.lease_seconds)
+            if claimed is None:
+                # Chunks leased by a worker that died come back once their lease runs out
+                progress = queue.progress()
+                if queue.get_meta('queued') is not None and progress['pending'] == 0 and progress['leased'] == 0:
+                    break
+                time.sleep(opt.poll_seconds)
+                continue
+            chunk_id, paths = claimed
+            relative = {os.path.join(opt.input,*path.split('/')): path for path in paths}
+            rows = []
+            renewed = time.monotonic()
+            lost = False
+            try:
+                for batch in pool.imap_unordered(process_batch,inference.batched(list(relative),opt.batch_size)):
+                    image_count = image_count + len(batch)
+                    for filename, detections in batch:
+                        rows.extend(row[:4] + (relative[filename],) + row[5:] for row in postprocessing.rows(filename,detections))
+                    if time.monotonic() - renewed > opt.lease_seconds / 3:
+                        renewed = time.monotonic()
+                        if not queue.renew(chunk_id,owner,opt.lease_seconds):
+                            lost = True
+                            break
+            except BaseException:
+                queue.release(chunk_id,owner)
+                raise
+            if lost or not queue.complete(chunk_id,owner,rows):
+                logger.warning(f'Lost the lease on chunk {chunk_id}, another worker has it')
+            else:
+                logger.warning(f'Finished chunk {chunk_id} ({len(paths)} images)')
+            super_logger.info(chunk_id)
+        # Let the workers exit on their own so they finish saving images
+        pool.close()
+        pool.join()
+    queue.close()
+    if run_settings['stage_timers'] or opt.cprofile:
+        profiling.write_profile(os.path.join(opt.output,'profile-{}.json'.format(owner.replace(':','-'))),run_settings['profile_dir'],
+                                profile_info(opt,image_count,time.monotonic() - run_start,startup_seconds,run_settings['request_limit'].stats()))
+
+
+## The command line options, also used by the benchmark to build a run's options
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--download', action='store_true',
                     help='Download image')
@@ -263,17 +793,109 @@ def run():
                         default=40, help='threshold of model')
     parser.add_argument('--output_style', type=str,
                         default='class', help='Download image')
+    parser.add_argument('--class_thresh', type=str,
+                        help='per class thresholds overriding --thresh, e.g. rat=60,cat=50')
+    parser.add_argument('--top_k', type=int,
+                        help='keep at most this many detections per image')
+    parser.add_argument('--nms', type=str, choices=nms.MODES,
+                        default='agnostic', help='non-maximum suppression across all classes, within each class, or none')
+    parser.add_argument('--iou_thresh', type=float,
+                        default=nms.DEFAULT_IOU_THRESHOLD, help='overlap (0-1) above which the less confident of two boxes is dropped')
+    parser.add_argument('--max_predictions', type=int,
+                        default=nms.DEFAULT_MAX_PREDICTIONS, help='most detections kept per image after non-maximum suppression')
     parser.add_argument('--input_size', type=int,
                         default=256, help='size of images into model')
     parser.add_argument('--max_images', type=int,
                         help='size of images into model')
+    parser.add_argument('--extensions', type=str,
+                        default=scan.DEFAULT_EXTENSIONS, help='comma separated image file extensions to process (any case)')
+    parser.add_argument('--include', type=str, action='append',
+                        help='only process paths (relative to the input folder) matching this glob, can be repeated')
+    parser.add_argument('--exclude', type=str, action='append',
+                        help='skip paths (relative to the input folder) matching this glob, can be repeated')
     parser.add_argument('--output_size', type=int,
                         help='size of images into output folder')
     parser.add_argument('--overwrite', action='store_true',
                         help='size of images into model')
+    parser.add_argument('--force', action='store_true',
+                        help='re-run images that changed since they were last processed')
     parser.add_argument('--only_timelapse',action='store_true',
                         help='Only run timelapse json creation')
+    parser.add_argument('--stop_container', action='store_true',
+                        help='stop the model container when done instead of keeping it for the next run')
+    parser.add_argument('--detections_format', type=str, choices=sinks.FORMATS,
+                        default='csv', help='file format detections are written in')
+    parser.add_argument('--flush_rows', type=int,
+                        default=1000, help='detection rows buffered before they are written out')
+    parser.add_argument('--flush_seconds', type=float,
+                        default=5, help='longest time detection rows are buffered before they are written out')
+    parser.add_argument('--checkpoint_every', type=int,
+                        default=500, help='images between syncing detections to disk and saving the resume index')
+    parser.add_argument('--render_workers', type=int,
+                        default=2, help='threads per worker drawing boxes and saving output images')
+    parser.add_argument('--render_queue', type=int,
+                        default=8, help='output images waiting to be saved before workers wait for the savers')
+    parser.add_argument('--jpeg_quality', type=int,
+                        default=75, help='JPEG quality of saved output images')
+    parser.add_argument('--jpeg_optimize', action='store_true',
+                        help='spend extra time to make saved output images smaller')
+    parser.add_argument('--placement', type=str, choices=render.PLACEMENTS,
+                        default='reflink', help='how full size copies without boxes are put in the output folder: cloned, copied, hard linked, or decoded and re-saved')
+    parser.add_argument('--role', type=str, choices=['coordinator','worker'],
+                        help='distributed run: queue the input folder and merge the results, or process chunks from the queue')
+    parser.add_argument('--queue', type=str,
+                        help='distributed run: work queue file on a folder every machine can reach')
+    parser.add_argument('--chunk_size', type=int,
+                        default=256, help='distributed run: images a worker leases at a time')
+    parser.add_argument('--lease_seconds', type=float,
+                        default=600, help='distributed run: how long a chunk stays with a worker that stops reporting back')
+    parser.add_argument('--poll_seconds', type=float,
+                        default=10, help='distributed run: how often to check the queue while waiting')
+    parser.add_argument('--replicas', type=int,
+                        default=1, help='model containers to run, each pinned to its own share of the CPUs, with requests spread between them')
+    parser.add_argument('--ready_timeout', type=float,
+                        default=120, help='seconds to wait for the container to load the model before giving up')
+    parser.add_argument('--warmup_batches', type=int,
+                        default=2, help='blank batches sent to the model before the run starts')
+    parser.add_argument('--batch_size', type=int,
+                        default=8, help='number of images sent to the model in one request')
+    parser.add_argument('--max_wait', type=float,
+                        default=0.5, help='seconds to wait for a batch to fill before sending it anyway')
+    parser.add_argument('--transport', type=str, choices=inference.TRANSPORTS,
+                        default='json', help='how images are sent to the model: json pixel lists, b64 encoded JPEGs (model must accept encoded images) or grpc tensors')
+    parser.add_argument('--engine', type=str, choices=['pool','async','shm'],
+                        default='pool', help='run workers as a process pool, as an asyncio client in one process, or as decode processes feeding one client through shared memory')
+    parser.add_argument('--max_in_flight', type=int,
+                        help=f'async and shm engines: most batch requests waiting on the model at once (default: a fixed --concurrency, or {ADAPTIVE_IN_FLIGHT} per replica for adaptive)')
+    parser.add_argument('--concurrency', type=str,
+                        default='adaptive', help='batch requests in flight: adaptive (tuned from their latency, up to max_in_flight, or the number of workers for the pool engine) or a fixed number')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: CPUs - 2)')
+    parser.add_argument('--max_memory', type=str,
+                        help='memory budget for this run\'s processes (not the model container), e.g. 4g: new batches are held back while their combined memory is near it')
+    parser.add_argument('--decode_workers', type=int,
+                        default=4, help='async engine: threads decoding, drawing and saving images')
+    parser.add_argument('--shm_slots', type=int,
+                        help='shm engine: decoded images the shared memory ring holds (default max_in_flight x batch_size, up to 512 MB)')
+    parser.add_argument('--no_timers', action='store_true',
+                        help='turn off the per-stage timers behind profile.json')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='run cProfile in every process and save its stats in the profile folder of the output')
+    parser.add_argument('--metrics_port', type=int,
+                        help='serve live metrics in the Prometheus text format at http://<metrics_host>:<port>/metrics')
+    parser.add_argument('--metrics_host', type=str,
+                        default='127.0.0.1', help='address the metrics endpoint listens on')
+    parser.add_argument('--class_names', type=str,
+                        help='comma separated class names of the model, instead of reading them from its image')
+    return parser
+
+
+## Set up the processing parameters and fill in anything not covered by CLI parameters with user input
+def run():
+    parser = make_parser()
     opt = parser.parse_args()
+    if opt.max_memory is not None and not memory.measurable():
+        parser.error('--max_memory needs psutil installed to measure memory use on this machine')
 
     if opt.only_timelapse:
         utils.generate_timelapse_file(opt)
@@ -282,8 +904,9 @@ def run():
 
     client = docker.from_env()
 
-    num_workers = multiprocessing.cpu_count() - 2
+    num_workers = max(multiprocessing.cpu_count() - 2, 1)
     ## Check Organization Bucket
+    cli_folders = (opt.input, opt.output)
     opt.org=user_input['Organization']
     opt.model=user_input['Model']
     opt.input=user_input["Import from"]
@@ -291,6 +914,17 @@ def run():
     opt.output_style='class'
     opt.thresh=40
 
+    if opt.role is not None:
+        # Each machine in a distributed run mounts the folders in its own place, so they can come from the command line
+        opt.input = cli_folders[0] or opt.input
+        opt.output = cli_folders[1] or opt.output
+        if opt.queue is None:
+            print('--queue is needed for a distributed run')
+            return
+    if opt.role == 'coordinator':
+        run_coordinator(opt)
+        return
+
     inputExist=os.path.exists(opt.input)
     outputExist = os.path.exists(opt.output)
     if not inputExist or not outputExist:
@@ -301,31 +935,9 @@ def run():
     if opt.org is None:
         print('input org')
         return
-    container_name = "us-west2-docker.pkg.dev/sentinel-project-278421/{}/{}".format(opt.org,opt.org)
-    try:
-        query = f'docker kill sentinel'
-        os.system(query)
-        client.containers.prune()
-        if utils.connect():
-            client.images.pull(container_name)
-        container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g')
-    except Exception as e:
-            opt.key = f'{opt.org}.json'
-            if platform.system() == 'Windows':
-                query = f'docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev < {opt.key}'
-            else:
-                query = f'cat {opt.key} | docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev'
-            os.system(query)
-            while True:
-                container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g')
-
-
-    available_algs = utils.check_available_algs(container).split(',')
-
-    ## Change the MODELNAME environmental variable
-    container.kill()
-    client.containers.prune()
-    container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g',environment=[f'MODEL_NAME={opt.model}'])
+    ## Reuse the running container if it serves the current image, otherwise pull (only if out of date) and start one
+    manager = containers.ContainerManager(client,opt.org,cpu_count=num_workers,key=f'{opt.org}.json')
+    container = manager.ensure_replicas(opt.model,opt.replicas)[0]
 
     while True:
         # Check the input folder exists (exit if it doesnt)
@@ -346,16 +958,18 @@ def run():
 
 
 
-    main(opt,container)
+    if opt.role == 'worker':
+        run_worker(opt,container)
+    else:
+        main(opt,container)
 
-    ## Clean up
-    logger.debug('\nShutting down container')
-    container.kill()
-    client.containers.prune()
+    ## The container is left running for the next run unless asked to stop it
+    if opt.stop_container:
+        logger.debug('\nShutting down container')
+        manager.stop()
 
 
 if __name__ == '__main__':
-    os.system('docker kill sentinel')
     run()
 
 
@@ -21,6 +21,7 @@ import inquirer
 import platform
 import logging
 import utils
+import containers
 import io
 
 #gets organization from user input
@@ -264,40 +265,14 @@ def run():
     ## Check Organization Bucket
     opt.org=org
     logger.info(opt.org)
-    logger.info('starting container')
-    container_name = "us-west2-docker.pkg.dev/sentinel-project-278421/{}/{}".format(opt.org,opt.org)
-    try:
-        query = f'docker kill sentinel'
-        os.system(query)
-        client.containers.prune()
-        if utils.connect():
-            logger.info('Pulling Container')
-            client.images.pull(container_name)
-        logger.info('Starting container')
-        container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g')
-        logger.info('Container created successfully')
-    except Exception as e:
-            logger.error(e)
-            print(e)
-            if os.path.exists(f'{opt.org}.json'):
-                logger.info('Key Found!')
-            opt.key = f'{opt.org}.json'
-            #elif opt.key is None:
-              #  opt.key = input("Path to credential key: ")
-            if platform.system() == 'Windows':
-                logger.info('Adding auth key to Windows')
-                query = f'docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev < {opt.key}'
-            else:
-                logger.info('Adding auth key to Linux/Mac')
-                query = f'cat {opt.key} | docker login -u _json_key --password-stdin https://us-west2-docker.pkg.dev'
-            logger.info(query)
-            os.system(query)
-            while True:
-                logger.info(f'Downloading Image from Google Cloud Platform with {opt.key} credentials')
-                container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g')
-
-
-    available_algs = utils.check_available_algs(container).split(',')
+    # Models are listed from the local image's environment (pulled only if missing), without starting a container
+    manager = containers.ContainerManager(client,opt.org,cpu_count=num_workers,key=f'{opt.org}.json')
+    image = manager.local_image()
+    if image is None:
+        logger.info('Pulling Container')
+        image = manager.pull()
+
+    available_algs = utils.check_available_algs(image).split(',')
     dictionary = [{
         "models": available_algs
     }]
@@ -332,10 +307,9 @@ def run():
 
         opt.model = inquirer.prompt(questions)['model']
 
-    ## Change the MODELNAME environmental variable
-    container.kill()
-    client.containers.prune()
-    container = client.containers.run(container_name,detach=True, name=f'sentinel',ports={8501:8501},cpu_count=num_workers,mem_limit='5g',environment=[f'MODEL_NAME={opt.model}'])
+    # Reuses the running container when it already serves the current image
+    logger.info('starting container')
+    container = manager.ensure(opt.model)
 
     while True:
         if opt.input is None:
@@ -367,12 +341,6 @@ def run():
 
     main(opt,container)
 
-    ## Clean up
-    print('\nShutting down container')
-    container.kill()
-    client.containers.prune()
-
 
 if __name__ == '__main__':
-    os.system('docker kill sentinel')
     run()
@@ -0,0 +1,62 @@
+## Finding the images to process
+import fnmatch
+import os
+
+DEFAULT_EXTENSIONS = 'jpg,jpeg,png'
+
+
+def parse_extensions(extensions):
+    """'jpg,.PNG' -> {'.jpg', '.png'}"""
+    return {'.' + ext.strip().lstrip('.').lower() for ext in extensions.split(',') if ext.strip()}
+
+
+def matches(relative_path, patterns):
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+
+def scan_key(relative_path):
+    """Sort key for the order scan_images yields paths in: a folder's files by name, then its subfolders by name"""
+    parts = relative_path.split('/')
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+def scan_images(root, extensions=DEFAULT_EXTENSIONS, include=None, exclude=None, start_after=None):
+    """Yield image paths under root as they are found, rather than after the whole tree has been walked.
+    Extensions are matched case-insensitively. include/exclude are glob patterns matched against
+    the path relative to root (with / separators), e.g. 'camera1/*' or '*/thumbnails/*'.
+    start_after (a relative path) picks up after that path, without listing the folders that come before it"""
+    extensions = parse_extensions(extensions)
+    include = include or []
+    exclude = exclude or []
+    after = scan_key(start_after) if start_after is not None else None
+    folders = [(root, ())]
+    while len(folders) != 0:
+        folder, prefix = folders.pop()
+        try:
+            entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subfolders = []
+        for entry in entries:
+            try:
+                # Like os.walk, don't follow links to folders, which can point back up the tree
+                if entry.is_dir(follow_symlinks=False):
+                    subfolder = prefix + ((1, entry.name),)
+                    # Everything in a folder that sorts before start_after's folder was done already
+                    if after is None or subfolder >= after[:len(subfolder)]:
+                        subfolders.append((entry.path, subfolder))
+                    continue
+            except OSError:
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+            if after is not None and prefix + ((0, entry.name),) <= after:
+                continue
+            relative_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+            if include and not matches(relative_path, include):
+                continue
+            if exclude and matches(relative_path, exclude):
+                continue
+            yield entry.path
+        # Walk subfolders in name order
+        folders.extend(reversed(subfolders))
@@ -0,0 +1,62 @@
+## A ring of shared memory slots holding decoded model inputs, so decode worker processes
+## hand images to the inference client without pickling them through a pipe
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SlotRing:
+    """slots fixed size uint8 arrays of shape in one shared memory block.
+    The process that creates the ring owns it: it hands out free slots with acquire(),
+    takes them back with release() once the image has been sent, and unlinks the block on close().
+    Decode workers attach by name and only ever write into the slots they were given"""
+
+    def __init__(self, slots, shape, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.owner = name is None
+        slot_bytes = int(np.prod(self.shape))
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.array = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.memory.buf)
+        self.free = list(range(slots))
+        self.available = threading.Condition()
+        self.closed = False
+
+    def acquire(self, count):
+        """Take count free slots, waiting until they are all free at once so two callers never hold half a batch each"""
+        if count > self.slots:
+            raise ValueError(f'Asked for {count} slots from a ring of {self.slots}')
+        with self.available:
+            self.available.wait_for(lambda: len(self.free) >= count)
+            taken, self.free = self.free[:count], self.free[count:]
+        return taken
+
+    def release(self, slots):
+        with self.available:
+            self.free.extend(slots)
+            self.available.notify_all()
+
+    def view(self, slot):
+        """The image in a slot, without copying it. Only valid until the slot is released"""
+        return self.array[slot]
+
+    def write(self, slot, image):
+        self.array[slot] = np.asarray(image, dtype=np.uint8).reshape(self.shape)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # The buffer can't be closed while numpy still points into it
+        del self.array
+        try:
+            self.memory.close()
+        except BufferError:
+            # A request thread cut short by an interrupt still holds a view. Unlinking is what frees the memory
+            pass
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,234 @@
+## Writing detections out. Only the main process writes, so workers never contend for the file
+import csv
+import glob
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import pandas as pd
+
+# Parquet output is optional (pip install pyarrow)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger('first_logger')
+
+FIELDS = ['File','Class Name','ClassID','Confidence','Path','ymin','xmin','ymax','xmax']
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def fsync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+class DetectionSink:
+    """Buffers rows (tuples in FIELDS order) and writes them out once flush_rows are waiting
+    or flush_seconds have passed since the last write. checkpoint() also forces them to disk and returns
+    an offset marking how much is safely written. Opening a sink with that offset again throws away
+    anything written after it, such as the torn last row of a run that crashed"""
+
+    def __init__(self, path, flush_rows=1000, flush_seconds=5):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) != 0:
+            self.write_rows(self.buffer)
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def checkpoint(self):
+        self.flush()
+        self.sync()
+        return self.offset()
+
+    def close(self):
+        self.checkpoint()
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def sync(self):
+        raise NotImplementedError
+
+    def offset(self):
+        raise NotImplementedError
+
+
+def truncate(path, offset):
+    """Cut a file back to offset bytes, if it has grown past that since the checkpoint"""
+    if offset is not None and os.path.exists(path) and os.path.getsize(path) > offset:
+        logger.warning(f'Dropping {os.path.getsize(path) - offset} bytes written to {path} after the last checkpoint')
+        with open(path, 'rb+') as file:
+            file.truncate(offset)
+
+
+class CsvSink(DetectionSink):
+    def __init__(self, path, flush_rows=1000, flush_seconds=5, offset=None):
+        super().__init__(path, flush_rows, flush_seconds)
+        truncate(path, offset)
+        if os.path.exists(path) and os.path.getsize(path) != 0:
+            with open(path, newline='') as file:
+                header = next(csv.reader(file), None)
+            if header != FIELDS:
+                # Rows in the new layout can't be appended under an old header
+                logger.warning(f'{path} has an older layout, moving it to {path}.old')
+                os.replace(path, path + '.old')
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(FIELDS)
+
+    def write_rows(self, rows):
+        self.writer.writerows([['' if isinstance(value, float) and math.isnan(value) else value for value in row] for row in rows])
+
+    def sync(self):
+        fsync(self.file)
+
+    def offset(self):
+        return self.file.tell()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class JsonlSink(DetectionSink):
+    def __init__(self, path, flush_rows=1000, flush_seconds=5, offset=None):
+        super().__init__(path, flush_rows, flush_seconds)
+        truncate(path, offset)
+        self.file = open(path, 'a')
+
+    def write_rows(self, rows):
+        lines = []
+        for row in rows:
+            record = {field: (None if isinstance(value, float) and math.isnan(value) else value) for field, value in zip(FIELDS, row)}
+            lines.append(json.dumps(record) + '\n')
+        self.file.write(''.join(lines))
+
+    def sync(self):
+        fsync(self.file)
+
+    def offset(self):
+        return self.file.tell()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ParquetSink(DetectionSink):
+    """Writes a folder of parquet part files. A part is only readable once closed,
+    so every checkpoint closes the current part and the next flush starts a new one.
+    The offset is the list of finished parts"""
+
+    def __init__(self, path, flush_rows=1000, flush_seconds=5, offset=None):
+        if pa is None:
+            raise ImportError('Parquet output needs pyarrow installed')
+        super().__init__(path, flush_rows, flush_seconds)
+        os.makedirs(path, exist_ok=True)
+        # Unfinished parts, and parts finished after the checkpoint, belong to images that will be processed again
+        for name in os.listdir(path):
+            if name.endswith('.tmp') or (offset is not None and name not in offset):
+                logger.warning(f'Dropping {name}, written after the last checkpoint')
+                os.remove(os.path.join(path, name))
+        self.schema = pa.schema([('File', pa.string()), ('Class Name', pa.string()), ('ClassID', pa.int32()),
+                                 ('Confidence', pa.float64()), ('Path', pa.string()), ('ymin', pa.float64()),
+                                 ('xmin', pa.float64()), ('ymax', pa.float64()), ('xmax', pa.float64())])
+        self.writer = None
+        self.part_path = None
+
+    def write_rows(self, rows):
+        if self.writer is None:
+            self.part_path = os.path.join(self.path, f'part-{time.time_ns()}.parquet')
+            self.writer = pq.ParquetWriter(self.part_path + '.tmp', self.schema)
+        columns = [list(column) for column in zip(*rows)]
+        columns[1] = [str(value) for value in columns[1]]
+        arrays = [pa.array(column, type=field.type, from_pandas=True) for column, field in zip(columns, self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def sync(self):
+        if self.writer is not None:
+            self.writer.close()
+            with open(self.part_path + '.tmp', 'rb+') as file:
+                os.fsync(file.fileno())
+            os.replace(self.part_path + '.tmp', self.part_path)
+            self.writer = None
+
+    def offset(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.parquet'))
+
+
+SINKS = {'csv': CsvSink, 'jsonl': JsonlSink, 'parquet': ParquetSink}
+
+
+def sink_path(output, format):
+    return os.path.join(output, 'detections.' + format)
+
+
+def open_sink(output, format='csv', flush_rows=1000, flush_seconds=5, offset=None):
+    """Open the run's detections for appending. offset is what checkpoint() returned last time, if resuming"""
+    return SINKS[format](sink_path(output, format), flush_rows, flush_seconds, offset)
+
+
+def replace_detections(output, rows, format='csv'):
+    """Write rows as the complete detections of a run, replacing the old file only once the new one is whole"""
+    path = sink_path(output, format)
+    merge_path = path + '.merge'
+    if os.path.isdir(merge_path):
+        shutil.rmtree(merge_path)
+    elif os.path.exists(merge_path):
+        os.remove(merge_path)
+    sink = SINKS[format](merge_path)
+    sink.write(rows)
+    sink.close()
+    # Parquet detections are a folder, which can't be renamed over
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(merge_path, path)
+
+
+def load_detections(output, format=None):
+    """Read a run's detections back into a DataFrame with FIELDS columns, in format or else whichever format they were written in"""
+    if format == 'parquet' or format is None and os.path.exists(sink_path(output, 'parquet')):
+        return pd.concat([pd.read_parquet(part) for part in sorted(glob.glob(os.path.join(sink_path(output, 'parquet'), '*.parquet')))],
+                         ignore_index=True)
+    if format == 'jsonl' or format is None and os.path.exists(sink_path(output, 'jsonl')):
+        return pd.read_json(sink_path(output, 'jsonl'), lines=True, dtype={'Class Name': str})
+    df = pd.read_csv(sink_path(output, 'csv'), dtype={'Class Name': str, 'File': str, 'Path': str})
+    if 'Bounded Box' in df.columns:
+        # Files written before the bbox was split into columns
+        df = df[df['File'] != 'File']
+        bboxes = df['Bounded Box'].fillna('').str.strip('[]').str.split(',', expand=True).reindex(columns=range(4))
+        df[['ymin', 'xmin', 'ymax', 'xmax']] = bboxes.apply(pd.to_numeric, errors='coerce').to_numpy()
+        df = df.drop(columns=['Bounded Box'])
+    return df
+
+
+def remove_paths(output, paths, format='csv'):
+    """Rewrite a run's detections without the rows of paths, e.g. files about to be processed again.
+    Returns the rows removed, as a DataFrame"""
+    path = sink_path(output, format)
+    if len(paths) == 0 or not os.path.exists(path) or (format == 'parquet' and len(glob.glob(os.path.join(path, '*.parquet'))) == 0):
+        return pd.DataFrame(columns=FIELDS)
+    df = load_detections(output, format)
+    stale = df['Path'].isin(set(paths))
+    if stale.any():
+        kept = df[~stale].astype(object).where(df[~stale].notna(), math.nan)
+        replace_detections(output, kept.itertuples(index=False, name=None), format)
+    return df[stale]
@@ -0,0 +1,103 @@
+## Tests for memory.py, and a whole run kept within a memory budget (python -m pytest src/py)
+import os
+import threading
+import time
+import pytest
+from PIL import Image
+import benchmark
+import fake_serving
+import memory
+
+
+def test_parse_size():
+    assert memory.parse_size('4g') == 4 * 1024 ** 3
+    assert memory.parse_size('512M') == 512 * 1024 ** 2
+    assert memory.parse_size('1.5gb') == int(1.5 * 1024 ** 3)
+    assert memory.parse_size('1000') == 1000
+
+
+def test_dispatcher_bounds_pending():
+    dispatcher = memory.Dispatcher(2)
+    fed = dispatcher.feed(iter(range(5)))
+    assert [next(fed), next(fed)] == [0, 1]
+    later = []
+    thread = threading.Thread(target=lambda: later.extend(fed))
+    thread.start()
+    time.sleep(0.3)
+    # Held back until a batch out comes back
+    assert later == []
+    for _ in range(3):
+        dispatcher.done()
+    thread.join(5)
+    assert later == [2, 3, 4]
+
+
+class FakeBudget:
+    def __init__(self, peaks, exceeded=False):
+        self.peaks = iter(peaks)
+        self.exceeded = exceeded
+        self.high = 900
+        self.low = 800
+        self.pauses = 0
+
+    def take_peak(self):
+        return next(self.peaks)
+
+
+def test_dispatcher_grows_while_there_is_room():
+    dispatcher = memory.Dispatcher(8, FakeBudget([100, 200, 950, 300]))
+    fed = dispatcher.feed(iter(range(10)))
+    assert next(fed) == 0
+    assert dispatcher.blocked()
+    dispatcher.done()
+    assert dispatcher.allowed == 2
+    assert [next(fed), next(fed)] == [1, 2]
+    dispatcher.done()
+    assert dispatcher.allowed == 3
+    # Over the high mark: halved
+    dispatcher.done()
+    assert dispatcher.allowed == 1
+    dispatcher.done()
+    assert dispatcher.allowed == 2
+    dispatcher.close()
+
+
+def test_dispatcher_lets_one_through_over_budget():
+    dispatcher = memory.Dispatcher(4, FakeBudget([1000] * 3, exceeded=True))
+    fed = dispatcher.feed(iter(range(3)))
+    assert next(fed) == 0
+    dispatcher.done()
+    assert next(fed) == 1
+    dispatcher.close()
+    assert list(fed) == []
+
+
+def make_solid_fixtures(folder, count, width, height):
+    """Big JPEGs that are quick to write"""
+    for i in range(count):
+        os.makedirs(os.path.join(folder, f'camera_{i % 2}'), exist_ok=True)
+        Image.new('RGB', (width, height), (i * 5 % 255, 100, 50)).save(os.path.join(folder, f'camera_{i % 2}', f'{i}.jpg'))
+
+
+@pytest.mark.skipif(not memory.measurable(), reason='memory use can not be measured here (pip install psutil)')
+def test_pipeline_within_budget(tmp_path):
+    input = os.path.join(tmp_path, 'input')
+    make_solid_fixtures(input, 32, 4000, 3000)
+    # Resized output copies are kept from decoding until they are saved, so with a slow model every worker holds
+    # a batch of full size images at once unless the budget holds batches back. The shm engine decodes into
+    # its fixed ring instead, so batches out don't add up there and the budget doesn't come into it
+    args = ['--model', 'fake', '--class_names', 'class_1,class_2', '--batch_size', '4', '--workers', '4',
+            '--output_size', '4000', '--transport', 'b64', '--max_memory']
+    limit = '700m'
+    profiles = {}
+    for max_memory in ['100g', limit]:
+        serving = fake_serving.FakeServing(latency=1.0, image_latency=0.01)
+        [(_, profiles[max_memory], _, _)] = benchmark.bench_pipeline(input, ['pool'], args + [max_memory], serving)
+    # A budget far above what the run needs never holds a batch back
+    unthrottled = profiles['100g']['memory']
+    assert unthrottled['pauses'] == 0
+    assert unthrottled['peak_rss'] > memory.parse_size(limit)
+    throttled = profiles[limit]['memory']
+    assert profiles[limit]['images'] == 32
+    assert throttled['pauses'] > 0
+    assert 0 < throttled['peak_rss'] <= memory.parse_size(limit)
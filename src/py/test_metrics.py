@@ -0,0 +1,83 @@
+## Scraping the metrics endpoint locally (python -m pytest src/py)
+import importlib
+import json
+import multiprocessing
+import os
+import types
+import urllib.error
+import urllib.request
+import pytest
+import concurrency
+import metrics
+import profiling
+
+
+@pytest.fixture(scope='module')
+def runCli2(tmp_path_factory):
+    # runCli2 reads the app's input data from the working folder as it is imported, and logs there
+    folder = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with open(os.getcwd() + "\\src\\py\\inputData.json", 'w') as file:
+            json.dump({}, file)
+        yield importlib.import_module('runCli2')
+    finally:
+        os.chdir(cwd)
+
+
+def scrape(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        return response.read().decode()
+
+
+def samples(text):
+    """{'name{labels}': value} for every sample line"""
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if not line.startswith('#')}
+
+
+def test_scrape(runCli2):
+    run_settings = {'request_limit': concurrency.AdaptiveLimit(4, 16, adaptive=False),
+                    'replica_load': multiprocessing.Array('i', 2),
+                    'render_depth': multiprocessing.Value('i', 3),
+                    'stage_metrics': metrics.stage_histograms()}
+    run_settings['replica_load'][1] = 2
+    run_settings['request_limit'].acquire()
+    observe = metrics.observer(run_settings['stage_metrics'])
+    for seconds in [0.0005, 0.003, 0.003, 0.2, 30]:
+        observe('request', seconds)
+    observe('decode', 0.01)
+    counts = {'images': 10, 'objects': 6, 'empty': 4, 'detections': 9, 'failed': 1}
+    sink = types.SimpleNamespace(buffer=[()] * 5)
+    server = metrics.MetricsServer(lambda: runCli2.metrics_text(run_settings, counts, 7, sink), 0)
+    try:
+        found = samples(scrape(server.url))
+        with pytest.raises(urllib.error.HTTPError):
+            scrape(server.url.replace('/metrics', '/other'))
+    finally:
+        server.close()
+
+    assert found['sentinel_images_processed_total'] == 10
+    assert found['sentinel_images_with_detections_total'] == 6
+    assert found['sentinel_empty_images_total'] == 4
+    assert found['sentinel_detections_total'] == 9
+    assert found['sentinel_image_errors_total'] == 1
+    assert found['sentinel_requests_in_flight'] == 1
+    assert found['sentinel_requests_in_flight_limit'] == 4
+    assert found['sentinel_replica_requests_in_flight{replica="1"}'] == 2
+    assert found['sentinel_images_pending'] == 7
+    assert found['sentinel_render_queue_depth'] == 3
+    assert found['sentinel_sink_buffered_rows'] == 5
+
+    # Buckets count every observation up to their bound, so they never go down and end at the total count
+    buckets = [found[f'sentinel_stage_seconds_bucket{{stage="request",le="{bound}"}}'] for bound in metrics.BUCKETS + ['+Inf']]
+    assert buckets == sorted(buckets)
+    assert found['sentinel_stage_seconds_bucket{stage="request",le="0.001"}'] == 1
+    assert found['sentinel_stage_seconds_bucket{stage="request",le="0.005"}'] == 3
+    assert found['sentinel_stage_seconds_bucket{stage="request",le="10"}'] == 4
+    assert buckets[-1] == found['sentinel_stage_seconds_count{stage="request"}'] == 5
+    assert found['sentinel_stage_seconds_sum{stage="request"}'] == pytest.approx(30.2065)
+    assert found['sentinel_stage_seconds_count{stage="decode"}'] == 1
+    assert all(found[f'sentinel_stage_seconds_count{{stage="{stage}"}}'] == 0 for stage in profiling.STAGES
+               if stage not in ('request', 'decode'))
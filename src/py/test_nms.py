@@ -0,0 +1,57 @@
+## Tests for nms.py on synthetic boxes (python -m pytest src/py)
+import numpy as np
+import nms
+import postprocessing
+
+
+def detections(rows):
+    """A structured detections array from (bbox, confidence, class_id) rows"""
+    array = np.zeros(len(rows), dtype=postprocessing.DETECTION_DTYPE)
+    for i, (bbox, confidence, class_id) in enumerate(rows):
+        array[i]['bbox'] = bbox
+        array[i]['confidence'] = confidence
+        array[i]['class_id'] = class_id
+    return array
+
+
+def test_overlapping_boxes_suppressed():
+    boxes = [[0, 0, 10, 10], [1, 1, 11, 11], [0, 0, 10, 10.5]]
+    assert nms.nms_indices(boxes, [0.8, 0.9, 0.7], iou_threshold=0.5).tolist() == [1]
+
+
+def test_overlap_at_threshold_kept():
+    # Halves of each other overlap with an IoU of 0.5 exactly
+    boxes = [[0, 0, 10, 10], [0, 0, 10, 5]]
+    assert nms.nms_indices(boxes, [0.9, 0.8], iou_threshold=0.5).tolist() == [0, 1]
+    assert nms.nms_indices(boxes, [0.9, 0.8], iou_threshold=0.4).tolist() == [0]
+
+
+def test_disjoint_boxes_kept():
+    boxes = [[0, 0, 10, 10], [20, 20, 30, 30], [0, 20, 10, 30]]
+    assert nms.nms_indices(boxes, [0.5, 0.9, 0.7]).tolist() == [1, 2, 0]
+
+
+def test_class_mode_keeps_other_classes():
+    found = detections([([0, 0, 10, 10], 0.9, 1), ([1, 1, 11, 11], 0.8, 2), ([0, 0, 10, 11], 0.7, 1)])
+    assert nms.suppress(found, 'class', iou_threshold=0.5)['confidence'].tolist() == [0.9, 0.8]
+    assert nms.suppress(found, 'agnostic', iou_threshold=0.5)['confidence'].tolist() == [0.9]
+    assert len(nms.suppress(found, 'none')) == 3
+
+
+def test_max_predictions_cap():
+    boxes = [[i * 20, 0, i * 20 + 10, 10] for i in range(10)]
+    scores = np.linspace(0.1, 1.0, 10)
+    assert nms.nms_indices(boxes, scores, max_predictions=3).tolist() == [9, 8, 7]
+
+
+def test_empty_input():
+    assert nms.nms_indices(np.zeros((0, 4)), []).tolist() == []
+    assert nms.nms_indices(np.zeros((0, 4)), [], class_ids=[]).tolist() == []
+    assert len(nms.suppress(detections([]), 'class')) == 0
+
+
+def test_zero_area_boxes():
+    boxes = np.array([[5, 5, 5, 5], [5, 5, 5, 5], [0, 0, 10, 10]], dtype=np.float64)
+    assert nms.iou(boxes[0], boxes).tolist() == [0, 0, 0]
+    # With nothing to overlap, degenerate boxes never suppress anything
+    assert nms.nms_indices(boxes, [0.9, 0.8, 0.7]).tolist() == [0, 1, 2]
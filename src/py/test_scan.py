@@ -0,0 +1,27 @@
+## Tests for scan.py (python -m pytest src/py)
+import os
+import pytest
+import scan
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def test_scan_order_and_start_after(tmp_path):
+    for name in ['b/2.jpg', 'b/1.JPG', 'a/x.png', 'top.jpg', 'a/notes.txt']:
+        touch(os.path.join(tmp_path, name))
+    found = [os.path.relpath(path, tmp_path).replace(os.sep, '/') for path in scan.scan_images(str(tmp_path))]
+    assert found == ['top.jpg', 'a/x.png', 'b/1.JPG', 'b/2.jpg']
+    rest = [os.path.relpath(path, tmp_path).replace(os.sep, '/') for path in scan.scan_images(str(tmp_path), start_after='a/x.png')]
+    assert rest == ['b/1.JPG', 'b/2.jpg']
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink') or os.name == 'nt', reason='needs symlinks')
+def test_folder_links_not_followed(tmp_path):
+    touch(os.path.join(tmp_path, 'a', 'x.jpg'))
+    # A link back up the tree, as found on NAS and card dump shares
+    os.symlink('..', os.path.join(tmp_path, 'a', 'loop'))
+    os.symlink('a', os.path.join(tmp_path, 'b'))
+    assert list(scan.scan_images(str(tmp_path))) == [os.path.join(str(tmp_path), 'a', 'x.jpg')]
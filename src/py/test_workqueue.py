@@ -0,0 +1,127 @@
+## Tests for workqueue.py, and a distributed run with a coordinator and several workers (python -m pytest src/py)
+import json
+import multiprocessing
+import os
+import signal
+import time
+import pytest
+import benchmark
+import fake_serving
+import sinks
+import workqueue
+
+
+def test_complete_needs_the_lease(tmp_path):
+    queue = workqueue.WorkQueue(os.path.join(tmp_path, workqueue.QUEUE_FILE))
+    assert queue.enqueue(['a.jpg', 'b.jpg'], chunk_size=2) == 2
+    assert queue.enqueue(['a.jpg'], chunk_size=2) == 0
+    # A lease that has already run out, as if its worker had died
+    chunk_id, paths = queue.claim('one', lease_seconds=0)
+    time.sleep(0.01)
+    assert queue.claim('two', lease_seconds=60) == (chunk_id, paths)
+    assert not queue.renew(chunk_id, 'one')
+    rows = [(path, 'class_1', 1, 0.9, path, 0.1, 0.2, 0.3, 0.4) for path in paths]
+    assert queue.complete(chunk_id, 'two', rows)
+    # The first worker coming back late doesn't get to store its rows too
+    assert not queue.complete(chunk_id, 'one', rows)
+    assert list(queue.rows()) == rows
+    assert queue.progress() == {'pending': 0, 'leased': 0, 'done': 2}
+    assert queue.claim('three') is None
+    queue.close()
+
+
+def run_role(workdir, args):
+    """Run a coordinator or worker in this process (a fresh one for each), in a session of its own so it can be
+    killed along with its pool"""
+    os.setsid()
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    # runCli2 reads the app's input data from the working folder as it is imported, and logs there
+    with open(os.getcwd() + "\\src\\py\\inputData.json", 'w') as file:
+        json.dump({}, file)
+    import runCli2
+    opt = runCli2.make_parser().parse_args(args)
+    if opt.role == 'coordinator':
+        runCli2.run_coordinator(opt)
+    else:
+        runCli2.run_worker(opt)
+
+
+def start_role(workdir, args):
+    process = multiprocessing.Process(target=run_role, args=(workdir, args))
+    process.start()
+    return process
+
+
+def leased_chunk(queue, pid):
+    """The chunk the worker with pid holds, if any"""
+    row = queue.connection.execute("SELECT id FROM chunks WHERE state = 'leased' AND owner LIKE ?", (f'%:{pid}',)).fetchone()
+    return row[0] if row is not None else None
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='needs process groups')
+def test_distributed_run_with_a_killed_worker(tmp_path):
+    input = os.path.join(tmp_path, 'input')
+    output = os.path.join(tmp_path, 'output')
+    os.makedirs(output)
+    count = 24
+    images = benchmark.make_fixture_tree(input, count, 320, 240, 2)
+    path = os.path.join(tmp_path, workqueue.QUEUE_FILE)
+    args = ['--input', input, '--output', output, '--queue', path, '--model', 'fake', '--class_names', 'class_1,class_2',
+            '--chunk_size', '4', '--batch_size', '2', '--workers', '1', '--lease_seconds', '3', '--poll_seconds', '0.2']
+    serving = fake_serving.FakeServing(latency=0.3, image_latency=0.01)
+    serving.start()
+    processes = []
+    try:
+        coordinator = start_role(os.path.join(tmp_path, 'coordinator'), args + ['--role', 'coordinator'])
+        processes.append(coordinator)
+        queue = workqueue.WorkQueue(path)
+        first = start_role(os.path.join(tmp_path, 'worker_0'), args + ['--role', 'worker'])
+        processes.append(first)
+
+        # Kill the first worker, pool and all, while it holds a chunk's lease
+        killed = None
+        deadline = time.monotonic() + 60
+        while killed is None and time.monotonic() < deadline:
+            if leased_chunk(queue, first.pid) is None:
+                time.sleep(0.05)
+                continue
+            os.killpg(first.pid, signal.SIGSTOP)
+            killed = leased_chunk(queue, first.pid)
+            if killed is None:
+                os.killpg(first.pid, signal.SIGCONT)
+                time.sleep(0.05)
+        assert killed is not None
+        os.killpg(first.pid, signal.SIGKILL)
+        first.join(10)
+
+        # The others pick its chunk up once the lease runs out
+        for i in [1, 2]:
+            processes.append(start_role(os.path.join(tmp_path, f'worker_{i}'), args + ['--role', 'worker']))
+        for process in processes[1:] + [coordinator]:
+            process.join(120)
+        assert [process.exitcode for process in processes] == [0, -signal.SIGKILL, 0, 0]
+    finally:
+        for process in processes:
+            if process.is_alive():
+                os.killpg(process.pid, signal.SIGKILL)
+                process.join()
+        serving.close()
+
+    [attempts] = queue.connection.execute('SELECT attempts FROM chunks WHERE id = ?', (killed,)).fetchone()
+    assert attempts >= 2
+    assert queue.progress() == {'pending': 0, 'leased': 0, 'done': count}
+
+    # Every image merged once: with the rows stored for it, all from the one chunk it was queued in
+    chunks = dict(queue.connection.execute('SELECT path, chunk FROM files'))
+    stored = {}
+    for chunk, relative in queue.connection.execute('SELECT chunk, path FROM rows'):
+        assert chunk == chunks[relative]
+        stored[relative] = stored.get(relative, 0) + 1
+    queue.close()
+    merged = sinks.load_detections(output, 'csv')
+    relative = merged['Path'].map(lambda path: os.path.relpath(path, input).replace(os.sep, '/'))
+    assert sorted(relative.unique()) == sorted(os.path.relpath(image, input).replace(os.sep, '/') for image in images)
+    assert relative.value_counts().to_dict() == stored
+    with open(os.path.join(tmp_path, 'coordinator') + "\\src\\py\\Results.json") as file:
+        assert json.load(file)[0]['imagecount'] == str(count)
@@ -3,68 +3,75 @@ import json
 import os
 import tqdm
 import shutil
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import urllib.request
+import sinks
+import metadata
+
+def timelapse_path(opt, path, class_name):
+    if opt.output_style == 'flat':
+        out_path = r'{}/{}'.format(opt.output,os.path.basename(path))
+    elif opt.output_style == 'hierachy' or opt.output_style == 'timelapse':
+        out_path = path.replace(f'{opt.input}\\','')
+    elif opt.output_style == 'class':
+        out_path = r'{}/{}/{}'.format(opt.output,class_name,os.path.basename(path))
+    else:
+        out_path = path
+    return out_path.replace('\\', '/')
+
 
 def generate_timelapse_file(opt):
     print('\nGenerating timelapse json file')
-    shutil.copy('TimelapseTemplate.tdb', f"{opt.output}/TimelapseTemplate.tdb")
+    if os.path.exists('TimelapseTemplate.tdb'):
+        shutil.copy('TimelapseTemplate.tdb', f"{opt.output}/TimelapseTemplate.tdb")
+
+    df = sinks.load_detections(opt.output)
+    # Drop failed images
+    df = df[(df['Class Name'].astype(str) != '99') & df['Path'].notna() & (df['Path'] != '')]
+    # Sort once so each image's rows are contiguous, then split at the boundaries
+    df = df.sort_values('Path', kind='stable')
+    paths = df['Path'].to_numpy()
+    class_names = df['Class Name'].astype(str).to_numpy()
+    class_ids = pd.to_numeric(df['ClassID'], errors='coerce').fillna(0).astype(int).to_numpy()
+    confidences = pd.to_numeric(df['Confidence'], errors='coerce').fillna(0).to_numpy()
+    bboxes = df[['ymin', 'xmin', 'ymax', 'xmax']].to_numpy(dtype=float)
+    starts = np.flatnonzero(np.r_[True, paths[1:] != paths[:-1]]) if len(paths) != 0 else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(paths)]
 
-    df = pd.read_csv(f'{opt.output}/detections.csv')
     now = datetime.now()
-
-    dict = {}
-
-    dict['info'] = {"detector": f'{opt.org}_{opt.model}',
-                    "detection_completion_time": now.strftime("%Y-%m-%d, %H:%M:%S"),
-                    "format_version": "1.0"}
-
-    dict['detection_categories'] = {"1": "rat"}
-    dict['classification_categories'] = {"1": "rat"}
-
-
-    image_list = []
-
-    images = df['Path'].unique()
-    pbar = tqdm.tqdm(total=len(images))
-    k= 0
-    while k < len(images):
-
-
-        x = []
-        bb = df[(df['Path']==images[k]) & (df['Confidence'] !=0)]
-        m = 0
-        while m < len(bb):
-
-
-            if opt.output_style == 'flat':
-                out_path = r'{}/{}/{}'.format(opt.output,os.path.basename(bb['Path'][0]))
-            elif opt.output_style == 'hierachy' or opt.output_style == 'timelapse':
-                out_path = bb['Path'][0].replace(f'{opt.input}\\','')
-            elif opt.output_style == 'none':
-                out_path = bb['Path'][0]
-            elif opt.output_style == 'class':
-                out_path = r'{}/{}/{}'.format(opt.output,bb['Class'][0],os.path.basename(os.path.basename(bb['Path'][0])))
-
-            bb_coco = eval(bb['Bounded Box'][m])
-            md_bb_list = [bb_coco[1],bb_coco[0],bb_coco[3]-bb_coco[1],bb_coco[2]-bb_coco[0]]
-            x.append({"category": str(int(float(bb['Class'][m]))),
-                    "conf": float(bb['Confidence'][m]),
-                    "bbox": md_bb_list,
-                    "classifications":[[str(int(float(bb['Class'][m]))),1]]})
-            m = m + 1
-
-        image_list.append({"file": out_path.replace('\\', '/'),
-                        "max_detection_conf": float(bb['Confidence'].max()),
-                        "detections":x})
-        pbar.update(1)
-        k = k + 1
-    pbar.close()
-    dict['images'] = image_list
-    json_object = json.dumps(dict, indent = 3)
+    info = {"detector": f'{opt.org}_{opt.model}',
+            "detection_completion_time": now.strftime("%Y-%m-%d, %H:%M:%S"),
+            "format_version": "1.0"}
+    detected = class_ids != 0
+    categories = {str(i): name for i, name in sorted(set(zip(class_ids[detected].tolist(), class_names[detected].tolist())))}
+
+    # Stream the images out one at a time rather than building the whole document in memory
+    pbar = tqdm.tqdm(total=len(starts))
     with open(r'{}/timelapse.json'.format(opt.output), 'w') as outfile:
-        outfile.write(json_object)
+        outfile.write('{\n"info": ' + json.dumps(info) +
+                      ',\n"detection_categories": ' + json.dumps(categories) +
+                      ',\n"classification_categories": ' + json.dumps(categories) +
+                      ',\n"images": [')
+        for n, (start, end) in enumerate(zip(starts, ends)):
+            rows = np.arange(start, end)[detected[start:end]]
+            top = rows[np.argmax(confidences[rows])] if len(rows) != 0 else None
+            x = []
+            for m in rows:
+                bb = bboxes[m]
+                category = str(class_ids[m])
+                x.append({"category": category,
+                          "conf": float(confidences[m]),
+                          "bbox": [bb[1], bb[0], bb[3]-bb[1], bb[2]-bb[0]],
+                          "classifications": [[category, 1]]})
+            image = {"file": timelapse_path(opt, paths[start], class_names[top] if top is not None else 'blank'),
+                     "max_detection_conf": float(confidences[top]) if top is not None else 0.0,
+                     "detections": x}
+            outfile.write((',\n' if n != 0 else '\n') + json.dumps(image))
+            pbar.update(1)
+        outfile.write('\n]\n}\n')
+    pbar.close()
 
 def connect(host='http://google.com'):
     try:
@@ -73,16 +80,12 @@ def connect(host='http://google.com'):
     except:
         return False
 
+## Read from the image's environment, cached by image digest, so nothing is run inside the container.
+## Both take either the container or its image
 def get_class_names(container,alg_name):
-    x = container.exec_run('env')
-    #print(x)
-    y = x[1].decode('utf-8').split('\n')
-    class_names = [i for i in y if f'{alg_name.upper()}_CLASSES' in i][0].split('=')[-1]
-    class_names = class_names.replace(',???','')
-    return class_names
+    image = getattr(container,'image',container)
+    return metadata.class_names(image,alg_name)
 
 def check_available_algs(container):
-    x = container.exec_run('env')
-    y = x[1].decode('utf-8').split('\n')
-    available_models = [i for i in y if 'AVAILABLE_MODELS' in i][0].split('=')[-1]
-    return available_models
+    image = getattr(container,'image',container)
+    return ','.join(metadata.available_models(image))
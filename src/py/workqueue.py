@@ -0,0 +1,125 @@
+## A work queue for spreading one run over several machines, kept in a SQLite file on a shared folder.
+## The coordinator adds the input files in chunks, workers lease chunks, process them against their own
+## model container and hand the rows back, and the coordinator merges them into one detections file
+import json
+import math
+import os
+import socket
+import sqlite3
+import time
+
+QUEUE_FILE = 'queue.db'
+
+
+def worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """Chunks of input paths (relative to the input folder) and the rows workers got for them.
+    A chunk is pending, leased to one worker until its lease runs out, or done.
+    A worker only gets to complete a chunk while it still holds the lease, and completing replaces any rows
+    already stored for the chunk, so a chunk processed twice (after a lease ran out) is only counted once"""
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # Waits for other machines' transactions instead of failing with 'database is locked'
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, chunk INTEGER);
+            CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, paths TEXT, state TEXT DEFAULT 'pending',
+                                               owner TEXT, lease_until REAL, attempts INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS rows (chunk INTEGER, file TEXT, class_name TEXT, class_id INTEGER, confidence REAL,
+                                             path TEXT, ymin REAL, xmin REAL, ymax REAL, xmax REAL);
+            CREATE INDEX IF NOT EXISTS rows_chunk ON rows (chunk);
+        ''')
+
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same chunk
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def enqueue(self, paths, chunk_size=256):
+        """Add chunks for the paths not queued before. Returns how many paths were added"""
+        paths = list(paths)
+        self.transaction()
+        try:
+            known = {path for (path,) in self.connection.execute('SELECT path FROM files')}
+            new = [path for path in paths if path not in known]
+            for start in range(0, len(new), chunk_size):
+                chunk = new[start:start + chunk_size]
+                chunk_id = self.connection.execute('INSERT INTO chunks (paths) VALUES (?)', (json.dumps(chunk),)).lastrowid
+                self.connection.executemany('INSERT INTO files VALUES (?, ?)', [(path, chunk_id) for path in chunk])
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return len(new)
+
+    def claim(self, owner, lease_seconds=600):
+        """Lease the next pending chunk, or one whose lease has run out. Returns (chunk id, paths), or None if there are none"""
+        now = time.time()
+        self.transaction()
+        try:
+            row = self.connection.execute("SELECT id, paths FROM chunks WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                                          "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE chunks SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                        (owner, now + lease_seconds, row[0]))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, chunk_id, owner, lease_seconds=600):
+        """Extend a lease. False if the lease was lost to another worker"""
+        cursor = self.connection.execute("UPDATE chunks SET lease_until = ? WHERE id = ? AND state = 'leased' AND owner = ?",
+                                         (time.time() + lease_seconds, chunk_id, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, chunk_id, owner, rows):
+        """Store a chunk's rows (tuples in sinks.FIELDS order, with relative paths) and mark it done.
+        False, and nothing stored, if the lease was lost"""
+        self.transaction()
+        try:
+            cursor = self.connection.execute("UPDATE chunks SET state = 'done', lease_until = NULL WHERE id = ? AND state = 'leased' AND owner = ?",
+                                             (chunk_id, owner))
+            if cursor.rowcount == 1:
+                self.connection.execute('DELETE FROM rows WHERE chunk = ?', (chunk_id,))
+                self.connection.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                            [(chunk_id, row[0], str(row[1]), *row[2:]) for row in rows])
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def release(self, chunk_id, owner):
+        """Give a leased chunk back, e.g. when a worker is stopped part way through it"""
+        self.connection.execute("UPDATE chunks SET state = 'pending', owner = NULL, lease_until = NULL WHERE id = ? AND state = 'leased' AND owner = ?",
+                                (chunk_id, owner))
+
+    def progress(self):
+        """{'pending': n, 'leased': n, 'done': n} counted in files"""
+        counts = {'pending': 0, 'leased': 0, 'done': 0}
+        for state, count in self.connection.execute('SELECT chunks.state, COUNT(*) FROM files JOIN chunks ON files.chunk = chunks.id GROUP BY chunks.state'):
+            counts[state] = count
+        return counts
+
+    def rows(self):
+        """Every stored row in chunk order, as tuples in sinks.FIELDS order with relative paths. Missing boxes are NaN"""
+        for row in self.connection.execute('SELECT file, class_name, class_id, confidence, path, ymin, xmin, ymax, xmax FROM rows ORDER BY chunk, rowid'):
+            yield tuple(row[:5]) + tuple(math.nan if value is None else value for value in row[5:])
+
+    def close(self):
+        self.connection.close()